@@ -2,18 +2,30 @@ import os
 import json
 import requests
 from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
 import urllib.parse
 import datetime
 import random
 import time
+import threading
+import sqlite3
+import fcntl
+import tempfile
+import hashlib
+import ipaddress
+import re
+import heapq
+import itertools
+import contextvars
 from functools import lru_cache
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from flask import Flask, render_template, request, jsonify, Response, redirect, url_for, session
+from contextlib import contextmanager
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed, wait, FIRST_COMPLETED, TimeoutError
+from flask import Flask, render_template, request, jsonify, Response, redirect, url_for, session, stream_with_context, g
 from functools import wraps
 
 app = Flask(__name__)
 app.config['JSON_AS_ASCII'] = False
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 3600
 app.secret_key = os.environ.get('SESSION_SECRET', os.environ.get('SECRET_KEY', 'choco-tube-secret-key-2025'))
 
 PASSWORD = os.environ.get('APP_PASSWORD', 'choco')
@@ -27,22 +39,173 @@ def login_required(f):
     return decorated_function
 
 YOUTUBE_API_KEY = os.environ.get('YOUTUBE_API_KEY', '')
+YOUTUBE_API_BASE = os.environ.get('YOUTUBE_API_BASE', 'https://www.googleapis.com/youtube/v3')
+YOUTUBE_VIDEOS_BATCH_SIZE = 50
+ISO8601_DURATION = re.compile(r'P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?')
 
 EDU_VIDEO_API = "https://siawaseok.duckdns.org/api/video2/"
 EDU_CONFIG_URL = "https://raw.githubusercontent.com/siawaseok3/wakame/master/video_config.json"
 STREAM_API = "https://ytdl-0et1.onrender.com/stream/"
 M3U8_API = "https://ytdl-0et1.onrender.com/m3u8/"
 
-_edu_params_cache = {'params': None, 'timestamp': 0}
-_trending_cache = {'data': None, 'timestamp': 0}
-_thumbnail_cache = {}
-
+CACHE_TTLS = {
+    'edu_params': 300,
+    'trending': 300,
+    'video': 600,
+    'channel': 900,
+    'channel_videos': 600,
+    'playlist': 900,
+    'comments': 300,
+    'comments_html': 300,
+    'video_stats': 3600,
+    'search': 300,
+    'hls_segment': 300,
+    'missing': 300,
+}
+CACHE_STALE_TTLS = {
+    'edu_params': 86400,
+    'trending': 86400,
+}
+SWR_REFRESH_AHEAD = 0.8
+SWR_RETRY_INTERVAL = 30
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'sqlite')
+CACHE_DB_PATH = os.environ.get('CACHE_DB_PATH', os.path.join(tempfile.gettempdir(), f'chocotube-{os.getuid()}', 'cache.sqlite3'))
+
+THUMBNAIL_TTL = 3600
+
+# Returned by loaders when an upstream definitively says the resource does
+# not exist, as opposed to None for "could not find out". Never stored
+# itself: load_and_cache records it under the 'missing' kind instead.
+NOT_FOUND = object()
+
+CACHE_POLICIES = {
+    'static': 'public, max-age=3600',
+    'thumbnail': f'public, max-age={THUMBNAIL_TTL}',
+    'suggest': 'public, max-age=300',
+    'api_search': 'public, max-age=300',
+    'api_trending': 'public, max-age=60',
+    'comments_api': 'public, max-age=300',
+    'api_channel_videos': 'public, max-age=300',
+}
+THUMBNAIL_MEMORY_BYTES = int(os.environ.get('THUMBNAIL_MEMORY_BYTES', str(32 * 1024 * 1024)))
+THUMBNAIL_DISK_BYTES = int(os.environ.get('THUMBNAIL_DISK_BYTES', str(256 * 1024 * 1024)))
+THUMBNAIL_CACHE_DIR = os.environ.get('THUMBNAIL_CACHE_DIR', os.path.join(tempfile.gettempdir(), f'chocotube-{os.getuid()}', 'thumbnails'))
+
+SUGGEST_CACHE_SIZE = int(os.environ.get('SUGGEST_CACHE_SIZE', '5000'))
+SUGGEST_TTL = 3600
+SUGGEST_FULL_PAGE = 10
+SUGGEST_MIN_LOCAL = 5
+
+PREFETCH_WORKERS = int(os.environ.get('PREFETCH_WORKERS', '2'))
+PREFETCH_QUEUE_SIZE = int(os.environ.get('PREFETCH_QUEUE_SIZE', '32'))
+PREFETCH_MAX_AGE = 30
+PREFETCH_RELATED = int(os.environ.get('PREFETCH_RELATED', '3'))
+
+WATCH_PAGE_DEADLINE = float(os.environ.get('WATCH_PAGE_DEADLINE', '20'))
+CHANNEL_PAGE_DEADLINE = float(os.environ.get('CHANNEL_PAGE_DEADLINE', '20'))
+WATCH_STREAMING = os.environ.get('WATCH_STREAMING', 'false')
+
+_page_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='page')
+
+STREAM_URL_DEFAULT_TTL = 300
+STREAM_URL_MAX_TTL = 6 * 3600
+STREAM_URL_SAFETY_MARGIN = int(os.environ.get('STREAM_URL_SAFETY_MARGIN', '600'))
+STREAM_EXPIRE_PATH = re.compile(r'/expire/(\d+)')
+
+_stream_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='stream')
+
+_inflight_lock = threading.Lock()
+_inflight = {}
+
+BATCH_MAX_IDS = int(os.environ.get('BATCH_MAX_IDS', '50'))
+BATCH_MAX_WORKERS = int(os.environ.get('BATCH_MAX_WORKERS', '8'))
+BATCH_DEADLINE = float(os.environ.get('BATCH_DEADLINE', '30'))
+
+_batch_executor = ThreadPoolExecutor(max_workers=BATCH_MAX_WORKERS, thread_name_prefix='batch')
+
+PAGE_PREFETCH_CONCURRENCY = int(os.environ.get('PAGE_PREFETCH_CONCURRENCY', '2'))
+
+_page_prefetch_executor = ThreadPoolExecutor(max_workers=PAGE_PREFETCH_CONCURRENCY, thread_name_prefix='page-prefetch')
+_page_prefetch_slots = threading.BoundedSemaphore(PAGE_PREFETCH_CONCURRENCY)
+
+_refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='refresh')
+_swr_lock = threading.Lock()
+_swr_scheduled = set()
+_swr_failed_at = {}
+
+REQUEST_DEADLINE = float(os.environ.get('REQUEST_DEADLINE', '30'))
+BACKGROUND_DEADLINE = float(os.environ.get('BACKGROUND_DEADLINE', '30'))
+UPSTREAM_RETRIES = int(os.environ.get('UPSTREAM_RETRIES', '2'))
+UPSTREAM_RETRY_BACKOFF = 0.1
+UPSTREAM_RETRY_STATUSES = {500, 502, 503, 504}
+
+_request_deadline = contextvars.ContextVar('request_deadline', default=None)
+
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), f'chocotube-{os.getuid()}', 'metrics'))
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+SLOW_REQUEST_THRESHOLD = float(os.environ.get('SLOW_REQUEST_THRESHOLD', '5'))
+SERVER_TIMING = os.environ.get('SERVER_TIMING', 'false')
+SERVER_TIMING_MAX_ENTRIES = 30
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Retries are done by upstream_get so they can be cut short by the
+# request deadline; the adapter itself never retries.
 http_session = requests.Session()
-retry_strategy = Retry(total=2, backoff_factor=0.1, status_forcelist=[500, 502, 503, 504])
-adapter = HTTPAdapter(max_retries=retry_strategy, pool_connections=20, pool_maxsize=20)
+adapter = HTTPAdapter(max_retries=0, pool_connections=20, pool_maxsize=20)
 http_session.mount("http://", adapter)
 http_session.mount("https://", adapter)
 
+# Leaves request threads free for pages (render.yaml runs 8 per worker) while
+# still fitting several viewers.
+MEDIA_PROXY_MAX_CONCURRENCY = int(os.environ.get('MEDIA_PROXY_MAX_CONCURRENCY', '6'))
+# Browsers overlap Range requests when seeking or fetching a trailing moov atom.
+MEDIA_PROXY_PER_CLIENT = int(os.environ.get('MEDIA_PROXY_PER_CLIENT', '2'))
+# X-Forwarded-For is only believed when it was set by a peer in one of these
+# comma-separated addresses or CIDR ranges. Behind a reverse proxy, list its
+# address range here or every viewer shares the proxy's per-client limit.
+MEDIA_PROXY_TRUSTED_PROXIES = [ipaddress.ip_network(net.strip(), strict=False)
+                               for net in os.environ.get('MEDIA_PROXY_TRUSTED_PROXIES', '').split(',') if net.strip()]
+MEDIA_PROXY_MAX_REDIRECTS = 3
+MEDIA_PROXY_QUEUE_TIMEOUT = float(os.environ.get('MEDIA_PROXY_QUEUE_TIMEOUT', '2'))
+MEDIA_PROXY_CHUNK_SIZE = 64 * 1024
+MEDIA_PROXY_FORWARD_HEADERS = ['Range', 'If-Range']
+MEDIA_PROXY_RESPONSE_HEADERS = ['Content-Type', 'Content-Length', 'Content-Range', 'Accept-Ranges', 'Last-Modified', 'ETag']
+
+# Media bytes get their own pool: no urllib3 retries (a retried Range
+# request would resend bytes) and connections kept warm for seeking.
+media_session = requests.Session()
+media_adapter = HTTPAdapter(max_retries=0, pool_connections=4, pool_maxsize=MEDIA_PROXY_MAX_CONCURRENCY * 2)
+media_session.mount("http://", media_adapter)
+media_session.mount("https://", media_adapter)
+
+# Per-process concurrency limit and queue timeout (seconds) for each class
+# of upstream, so one slow dependency cannot occupy every request thread.
+BULKHEAD_LIMITS = {
+    'invidious': (int(os.environ.get('BULKHEAD_INVIDIOUS_LIMIT', '8')), float(os.environ.get('BULKHEAD_INVIDIOUS_TIMEOUT', '1'))),
+    'streams': (int(os.environ.get('BULKHEAD_STREAMS_LIMIT', '4')), float(os.environ.get('BULKHEAD_STREAMS_TIMEOUT', '1'))),
+    'edu': (int(os.environ.get('BULKHEAD_EDU_LIMIT', '3')), float(os.environ.get('BULKHEAD_EDU_TIMEOUT', '0.5'))),
+    'thumbnail': (int(os.environ.get('BULKHEAD_THUMBNAIL_LIMIT', '6')), float(os.environ.get('BULKHEAD_THUMBNAIL_TIMEOUT', '0.5'))),
+    'suggest': (int(os.environ.get('BULKHEAD_SUGGEST_LIMIT', '3')), float(os.environ.get('BULKHEAD_SUGGEST_TIMEOUT', '0.2'))),
+}
+
+HLS_SEGMENT_CACHE_BYTES = int(os.environ.get('HLS_SEGMENT_CACHE_BYTES', str(64 * 1024 * 1024)))
+HLS_PREFETCH_SEGMENTS = int(os.environ.get('HLS_PREFETCH_SEGMENTS', '3'))
+HLS_SEGMENT_INDEX_SIZE = 5000
+HLS_URI_ATTRIBUTE = re.compile(r'URI="([^"]+)"')
+
+_hls_prefetch_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='hls')
+_hls_lock = threading.Lock()
+_hls_next_segments = OrderedDict()
+
+_media_proxy_slots = threading.BoundedSemaphore(MEDIA_PROXY_MAX_CONCURRENCY)
+_media_proxy_lock = threading.Lock()
+_media_proxy_clients = {}
+
 USER_AGENTS = [
     'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
     'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.6 Safari/605.1.15',
@@ -61,58 +224,1356 @@ INVIDIOUS_INSTANCES = [
     'https://iv.duti.dev/',
 ]
 
+INSTANCE_FAILURE_THRESHOLD = int(os.environ.get('INSTANCE_FAILURE_THRESHOLD', '3'))
+INSTANCE_COOLDOWN = float(os.environ.get('INSTANCE_COOLDOWN', '60'))
+INSTANCE_LATENCY_ALPHA = 0.3
+# A mirror with a broken API can answer 404 for everything, so a lookup is
+# only treated as missing once this many instances agree.
+INVIDIOUS_NOT_FOUND_QUORUM = 2
+
+_instance_lock = threading.Lock()
+_instance_stats = {
+    instance: {
+        'successes': 0,
+        'failures': 0,
+        'consecutive_failures': 0,
+        'latency': None,
+        'opened_at': None
+    }
+    for instance in INVIDIOUS_INSTANCES
+}
+
+HEDGE_DELAY = float(os.environ.get('HEDGE_DELAY', '0'))
+HEDGE_MIN_DELAY = 0.2
+HEDGE_MAX_RATIO = float(os.environ.get('HEDGE_MAX_RATIO', '0.1'))
+HEDGE_BURST = 10
+
+_latency_samples = deque(maxlen=200)
+_hedge_budget = {'tokens': float(HEDGE_BURST)}
+_hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='hedge')
+
 def get_random_headers():
     return {
         'User-Agent': random.choice(USER_AGENTS)
     }
 
-def get_edu_params():
-    cache_duration = 300
-    current_time = time.time()
+def get_cache_entry_size(value):
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    if isinstance(value, tuple):
+        return sum(get_cache_entry_size(item) for item in value)
+    return len(json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8'))
+
+class CacheBackend:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.counters = {}
+        self.counter_lock = threading.Lock()
+
+    def count(self, kind, name, amount=1):
+        with self.counter_lock:
+            counters = self.counters.setdefault(kind, {'hits': 0, 'misses': 0, 'evictions': 0})
+            counters[name] += amount
+
+    def get(self, kind, key):
+        value = self._lookup(kind, key)
+        self.count(kind, 'hits' if value is not None else 'misses')
+        return value
+
+    def peek(self, kind, key):
+        # Same lookup without touching the hit/miss counters, for re-checks
+        # and probes that are not a lookup of their own.
+        return self._lookup(kind, key)
+
+    def _lookup(self, kind, key):
+        raise NotImplementedError
+
+    def set(self, kind, key, value, ttl=None):
+        raise NotImplementedError
+
+    def get_usage(self):
+        raise NotImplementedError
+
+    def get_stats(self):
+        with self.counter_lock:
+            kinds = {kind: dict(counters) for kind, counters in self.counters.items()}
+        for counters in kinds.values():
+            lookups = counters['hits'] + counters['misses']
+            counters['hitRatio'] = round(counters['hits'] / lookups, 3) if lookups else None
+        entries, total_bytes = self.get_usage()
+        return {
+            'backend': type(self).__name__,
+            'entries': entries,
+            'bytes': total_bytes,
+            'maxBytes': self.max_bytes,
+            'kinds': kinds
+        }
+
+class MemoryCacheBackend(CacheBackend):
+    def __init__(self, max_bytes):
+        super().__init__(max_bytes)
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def _remove(self, key):
+        value, expires_at, size = self.entries.pop(key)
+        self.total_bytes -= size
+
+    def _lookup(self, kind, key):
+        cache_key = f"{kind}:{key}"
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            if entry is not None and entry[1] <= time.time():
+                self._remove(cache_key)
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(cache_key)
+        return entry[0] if entry is not None else None
+
+    def set(self, kind, key, value, ttl=None):
+        cache_key = f"{kind}:{key}"
+        ttl = ttl if ttl is not None else CACHE_TTLS.get(kind, 300)
+        size = get_cache_entry_size(value)
+        if size > self.max_bytes:
+            return
+        evicted = []
+        with self.lock:
+            if cache_key in self.entries:
+                self._remove(cache_key)
+            self.entries[cache_key] = (value, time.time() + ttl, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                oldest_key = next(iter(self.entries))
+                self._remove(oldest_key)
+                evicted.append(oldest_key.split(':', 1)[0])
+        for evicted_kind in evicted:
+            self.count(evicted_kind, 'evictions')
+
+    def get_usage(self):
+        with self.lock:
+            return len(self.entries), self.total_bytes
+
+class SQLiteCacheBackend(CacheBackend):
+    # Shared by every gunicorn worker on the host through one WAL-mode file.
+    TOUCH_INTERVAL = 30
+    EVICTION_INTERVAL = 64
+
+    def __init__(self, path, max_bytes):
+        super().__init__(max_bytes)
+        self.path = path
+        self.local = threading.local()
+        self.writes = 0
+        self.write_lock = threading.Lock()
+        ensure_private_dir(os.path.dirname(os.path.abspath(path)))
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache_entries ("
+            "key TEXT PRIMARY KEY, kind TEXT NOT NULL, value TEXT NOT NULL, "
+            "size INTEGER NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS cache_entries_accessed ON cache_entries (accessed_at)")
+
+    def _connect(self):
+        # Connections must not cross a fork, e.g. gunicorn --preload.
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def _lookup(self, kind, key):
+        cache_key = f"{kind}:{key}"
+        current_time = time.time()
+        try:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT value, expires_at, accessed_at FROM cache_entries WHERE key = ?", (cache_key,)
+            ).fetchone()
+            if row is not None and row[1] <= current_time:
+                conn.execute("DELETE FROM cache_entries WHERE key = ? AND expires_at <= ?", (cache_key, current_time))
+                row = None
+            if row is not None and current_time - row[2] > self.TOUCH_INTERVAL:
+                conn.execute("UPDATE cache_entries SET accessed_at = ? WHERE key = ?", (current_time, cache_key))
+            value = json.loads(row[0]) if row is not None else None
+        except Exception as e:
+            print(f"Cache read error: {e}")
+            value = None
+        return value
+
+    def set(self, kind, key, value, ttl=None):
+        cache_key = f"{kind}:{key}"
+        ttl = ttl if ttl is not None else CACHE_TTLS.get(kind, 300)
+        current_time = time.time()
+        try:
+            blob = json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+            size = len(blob.encode('utf-8'))
+            if size > self.max_bytes:
+                return
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO cache_entries (key, kind, value, size, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (cache_key, kind, blob, size, current_time + ttl, current_time)
+            )
+        except Exception as e:
+            print(f"Cache write error: {e}")
+            return
+        with self.write_lock:
+            self.writes += 1
+            should_evict = self.writes % self.EVICTION_INTERVAL == 0
+        if should_evict:
+            self.evict()
+
+    def evict(self):
+        current_time = time.time()
+        try:
+            conn = self._connect()
+            conn.execute("DELETE FROM cache_entries WHERE expires_at <= ?", (current_time,))
+            total_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache_entries").fetchone()[0]
+            if total_bytes <= self.max_bytes:
+                return
+            excess = total_bytes - self.max_bytes
+            evicted = {}
+            for key, kind, size in conn.execute(
+                    "SELECT key, kind, size FROM cache_entries ORDER BY accessed_at").fetchall():
+                if excess <= 0:
+                    break
+                conn.execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+                excess -= size
+                evicted[kind] = evicted.get(kind, 0) + 1
+            for kind, amount in evicted.items():
+                self.count(kind, 'evictions', amount)
+        except Exception as e:
+            print(f"Cache eviction error: {e}")
+
+    def get_usage(self):
+        try:
+            return self._connect().execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries WHERE expires_at > ?", (time.time(),)
+            ).fetchone()
+        except Exception as e:
+            print(f"Cache stats error: {e}")
+            return 0, 0
+
+def ensure_private_dir(path):
+    # Other local users must not be able to plant or edit cache files, nor
+    # swap the directory out from under us through a writable parent.
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.stat(path)
+    if st.st_uid != os.getuid() or st.st_mode & 0o022:
+        raise PermissionError(f"{path} is writable by other users")
+    parent = os.stat(os.path.dirname(os.path.abspath(path)))
+    if parent.st_uid not in (0, os.getuid()) or (parent.st_mode & 0o022 and not parent.st_mode & 0o1000):
+        raise PermissionError(f"{os.path.dirname(path)} is writable by other users")
+
+def create_cache_backend():
+    if CACHE_BACKEND == 'sqlite':
+        try:
+            return SQLiteCacheBackend(CACHE_DB_PATH, CACHE_MAX_BYTES)
+        except Exception as e:
+            print(f"SQLite cache unavailable, falling back to memory: {e}")
+    return MemoryCacheBackend(CACHE_MAX_BYTES)
+
+cache = create_cache_backend()
+
+class ThumbnailStore:
+    SWEEP_INTERVAL = 60
+
+    def __init__(self, directory, memory_bytes, disk_bytes, ttl):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.counters = {'memoryHits': 0, 'diskHits': 0, 'misses': 0, 'evictions': 0, 'diskEvictions': 0}
+        self.disk_total = 0
+        self.last_sweep = 0
+        try:
+            ensure_private_dir(directory)
+            self.disk_total = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+        except OSError as e:
+            print(f"Thumbnail disk cache unavailable: {e}")
+            self.directory = None
+
+    def _path(self, video_id):
+        return os.path.join(self.directory, hashlib.sha1(video_id.encode('utf-8')).hexdigest() + '.jpg')
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def _remember(self, video_id, data, stored_at):
+        # The strong ETag is computed once per stored copy, not per response.
+        entry = (data, hashlib.sha1(data).hexdigest(), stored_at)
+        if len(data) > self.memory_bytes:
+            return entry
+        with self.lock:
+            if video_id in self.entries:
+                self.total_bytes -= len(self.entries.pop(video_id)[0])
+            self.entries[video_id] = entry
+            self.total_bytes += len(data)
+            while self.total_bytes > self.memory_bytes:
+                _, (evicted, _, _) = self.entries.popitem(last=False)
+                self.total_bytes -= len(evicted)
+                self.counters['evictions'] += 1
+        return entry
+
+    def get(self, video_id):
+        current_time = time.time()
+        with self.lock:
+            entry = self.entries.get(video_id)
+            if entry is not None and current_time - entry[2] < self.ttl:
+                self.entries.move_to_end(video_id)
+                self.counters['memoryHits'] += 1
+                return entry
+
+        if self.directory:
+            path = self._path(video_id)
+            try:
+                stored_at = os.path.getmtime(path)
+                if current_time - stored_at < self.ttl:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                    entry = self._remember(video_id, data, stored_at)
+                    self._count('diskHits')
+                    return entry
+            except OSError:
+                pass
+
+        self._count('misses')
+        return None
+
+    def set(self, video_id, data):
+        entry = self._remember(video_id, data, time.time())
+        if not self.directory:
+            return entry
+        path = self._path(video_id)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Thumbnail disk write error: {e}")
+            return entry
+        with self.lock:
+            self.disk_total += len(data)
+            should_sweep = (self.disk_total > self.disk_bytes
+                            and time.time() - self.last_sweep > self.SWEEP_INTERVAL)
+            if should_sweep:
+                self.last_sweep = time.time()
+        if should_sweep:
+            self.sweep()
+        return entry
+
+    def sweep(self):
+        # The directory is shared by every worker, so recount it from disk.
+        current_time = time.time()
+        files = []
+        total = 0
+        try:
+            for entry in os.scandir(self.directory):
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                if current_time - stat.st_mtime >= self.ttl:
+                    os.remove(entry.path)
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+            files.sort()
+            target = self.disk_bytes * 0.9
+            removed = 0
+            for _, size, path in files:
+                if total <= target:
+                    break
+                os.remove(path)
+                total -= size
+                removed += 1
+        except OSError as e:
+            print(f"Thumbnail disk sweep error: {e}")
+            return
+        with self.lock:
+            self.disk_total = total
+            self.counters['diskEvictions'] += removed
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update({
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'maxBytes': self.memory_bytes,
+                'diskBytes': self.disk_total,
+                'maxDiskBytes': self.disk_bytes
+            })
+        return stats
+
+thumbnail_store = ThumbnailStore(THUMBNAIL_CACHE_DIR, THUMBNAIL_MEMORY_BYTES, THUMBNAIL_DISK_BYTES, THUMBNAIL_TTL)
+
+# Segments are large and short-lived, so they stay in process memory
+# rather than going through the shared metadata cache.
+hls_segment_cache = MemoryCacheBackend(HLS_SEGMENT_CACHE_BYTES)
+
+class SuggestionIndex:
+    # Keyed by every keyword already sent upstream. A keystroke that extends
+    # a cached keyword is answered by filtering that keyword's suggestions:
+    # authoritatively when the upstream list was not truncated, otherwise
+    # only when enough matches remain.
+    def __init__(self, max_entries, ttl, full_page, min_local):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.full_page = full_page
+        self.min_local = min_local
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'prefixHits': 0, 'misses': 0, 'evictions': 0}
+
+    def lookup(self, keyword):
+        current_time = time.time()
+        with self.lock:
+            for length in range(len(keyword), 0, -1):
+                prefix = keyword[:length]
+                entry = self.entries.get(prefix)
+                if entry is None:
+                    continue
+                suggestions, stored_at = entry
+                if current_time - stored_at >= self.ttl:
+                    del self.entries[prefix]
+                    continue
+                self.entries.move_to_end(prefix)
+                if length == len(keyword):
+                    self.counters['hits'] += 1
+                    return suggestions
+                matches = [s for s in suggestions if s.casefold().startswith(keyword)]
+                if len(suggestions) < self.full_page or len(matches) >= self.min_local:
+                    self.counters['prefixHits'] += 1
+                    return matches
+            self.counters['misses'] += 1
+        return None
+
+    def store(self, keyword, suggestions):
+        with self.lock:
+            self.entries[keyword] = (suggestions, time.time())
+            self.entries.move_to_end(keyword)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['entries'] = len(self.entries)
+        return stats
+
+class Prefetcher:
+    # Bounded priority queue drained by a few daemon threads. When the queue
+    # is full, a more urgent task displaces the least urgent one; tasks that
+    # waited longer than max_age are dropped unrun because the viewer has
+    # most likely moved on.
+    def __init__(self, workers, max_queue, max_age):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_age = max_age
+        self.heap = []
+        self.queued = set()
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.pid = None
+        self.counters = {'queued': 0, 'completed': 0, 'dropped': 0, 'expired': 0, 'failed': 0}
+
+    def _ensure_workers(self):
+        # Threads do not survive a fork, so start them in the serving process.
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        for i in range(self.workers):
+            threading.Thread(target=self._run, name=f'prefetch-{i}', daemon=True).start()
+
+    def submit(self, video_id, priority):
+        if not video_id:
+            return
+        with self.condition:
+            self._ensure_workers()
+            if video_id in self.queued:
+                return
+            if len(self.heap) >= self.max_queue:
+                worst = max(self.heap)
+                if worst[0] <= priority:
+                    self.counters['dropped'] += 1
+                    return
+                self.heap.remove(worst)
+                heapq.heapify(self.heap)
+                self.queued.discard(worst[3])
+                self.counters['dropped'] += 1
+            heapq.heappush(self.heap, (priority, next(self.sequence), time.time(), video_id))
+            self.queued.add(video_id)
+            self.counters['queued'] += 1
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.heap:
+                    self.condition.wait()
+                _, _, queued_at, video_id = heapq.heappop(self.heap)
+                self.queued.discard(video_id)
+                if time.time() - queued_at > self.max_age:
+                    self.counters['expired'] += 1
+                    continue
+            try:
+                run_with_deadline(BACKGROUND_DEADLINE, warm_video, video_id)
+                outcome = 'completed'
+            except Exception as e:
+                print(f"Prefetch of {video_id} failed: {e}")
+                outcome = 'failed'
+            with self.condition:
+                self.counters[outcome] += 1
+
+    def get_stats(self):
+        with self.condition:
+            stats = dict(self.counters)
+            stats['pending'] = len(self.heap)
+        return stats
+
+prefetcher = Prefetcher(PREFETCH_WORKERS, PREFETCH_QUEUE_SIZE, PREFETCH_MAX_AGE)
+
+suggestion_index = SuggestionIndex(SUGGEST_CACHE_SIZE, SUGGEST_TTL, SUGGEST_FULL_PAGE, SUGGEST_MIN_LOCAL)
+
+class BulkheadFull(Exception):
+    pass
+
+class DeadlineExceeded(Exception):
+    pass
+
+class Bulkhead:
+    # Caps concurrent calls to one upstream. Callers wait at most
+    # queue_timeout for a slot and otherwise get BulkheadFull, which every
+    # call site turns into its usual degraded answer.
+    def __init__(self, name, limit, queue_timeout):
+        self.name = name
+        self.limit = limit
+        self.queue_timeout = queue_timeout
+        self.slots = threading.BoundedSemaphore(limit)
+        self.lock = threading.Lock()
+        self.counters = {'active': 0, 'waiting': 0, 'accepted': 0, 'rejected': 0}
+
+    def __enter__(self):
+        queue_timeout = get_budget_timeout(self.queue_timeout)
+        with self.lock:
+            self.counters['waiting'] += 1
+        acquired = self.slots.acquire(timeout=queue_timeout)
+        with self.lock:
+            self.counters['waiting'] -= 1
+            if not acquired:
+                self.counters['rejected'] += 1
+                raise BulkheadFull(self.name)
+            self.counters['active'] += 1
+            self.counters['accepted'] += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self.lock:
+            self.counters['active'] -= 1
+        self.slots.release()
+        return False
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats['limit'] = self.limit
+        stats['queueTimeout'] = self.queue_timeout
+        return stats
+
+bulkheads = {name: Bulkhead(name, limit, queue_timeout) for name, (limit, queue_timeout) in BULKHEAD_LIMITS.items()}
+
+class Metrics:
+    # Per-process registry. Every worker writes a snapshot to its own file
+    # in METRICS_DIR; /metrics merges the snapshots of all live workers and
+    # the retired totals of dead ones, so whichever worker answers the
+    # scrape reports the whole host. Gauges
+    # describing shared state (the SQLite cache) merge with max, the rest
+    # are summed.
+    def __init__(self, directory, buckets, flush_interval):
+        self.directory = directory
+        self.buckets = buckets
+        self.flush_interval = flush_interval
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+        self.pid = None
+        try:
+            ensure_private_dir(directory)
+        except OSError as e:
+            print(f"Metrics directory unavailable, reporting this worker only: {e}")
+            self.directory = None
+
+    def _ensure_flusher(self):
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        threading.Thread(target=self._run, name='metrics', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self._ensure_flusher()
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def add_gauge(self, name, amount, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self._ensure_flusher()
+            self.gauges[key] = self.gauges.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self._ensure_flusher()
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def add_collector(self, collector):
+        # collector() yields (type, name, labels, value) read at snapshot time
+        # from components that keep their own counters.
+        self.collectors.append(collector)
+
+    def snapshot(self):
+        with self.lock:
+            counters = [[name, list(labels), value] for (name, labels), value in self.counters.items()]
+            gauges = [[name, list(labels), value, 'sum'] for (name, labels), value in self.gauges.items()]
+            histograms = [[name, list(labels), dict(h, buckets=list(h['buckets']))]
+                          for (name, labels), h in self.histograms.items()]
+        for collector in self.collectors:
+            try:
+                for metric_type, name, labels, value in collector():
+                    labels = sorted(labels.items())
+                    if metric_type == 'counter':
+                        counters.append([name, labels, value])
+                    else:
+                        gauges.append([name, labels, value, 'max' if metric_type == 'shared_gauge' else 'sum'])
+            except Exception as e:
+                print(f"Metrics collector error: {e}")
+        return {'counters': counters, 'gauges': gauges, 'histograms': histograms}
+
+    def flush(self):
+        if not self.directory:
+            return
+        try:
+            path = os.path.join(self.directory, f"metrics-{os.getpid()}.json")
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"Metrics flush error: {e}")
+
+    @staticmethod
+    def _read_snapshot(path):
+        with open(path) as f:
+            return json.load(f)
+
+    @staticmethod
+    def _write_snapshot(path, snapshot):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+
+    def _retire(self, path):
+        # A dead worker's counters and histograms are folded into
+        # metrics-dead.json so the merged totals never go backwards, which
+        # Prometheus would read as a reset. Its gauges die with it.
+        dead_path = os.path.join(self.directory, 'metrics-dead.json')
+        snapshot = self._read_snapshot(path)
+        snapshot['gauges'] = []
+        try:
+            snapshot = self._combine([self._read_snapshot(dead_path), snapshot])
+        except FileNotFoundError:
+            pass
+        self._write_snapshot(dead_path, snapshot)
+        os.remove(path)
+
+    def _load_snapshots(self):
+        snapshots = [self.snapshot()]
+        if not self.directory:
+            return snapshots
+        # Held across the whole read so no scrape sees a retired worker both
+        # in its own file and in metrics-dead.json.
+        try:
+            with open(os.path.join(self.directory, 'metrics.lock'), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                for name in os.listdir(self.directory):
+                    pid = name[len('metrics-'):-len('.json')]
+                    if not (name.startswith('metrics-') and name.endswith('.json') and pid.isdigit()):
+                        continue
+                    pid = int(pid)
+                    if pid == os.getpid():
+                        continue
+                    path = os.path.join(self.directory, name)
+                    try:
+                        os.kill(pid, 0)
+                    except ProcessLookupError:
+                        try:
+                            self._retire(path)
+                        except (OSError, ValueError) as e:
+                            print(f"Metrics snapshot retire error: {e}")
+                        continue
+                    except PermissionError:
+                        pass
+                    try:
+                        snapshots.append(self._read_snapshot(path))
+                    except (OSError, ValueError) as e:
+                        print(f"Metrics snapshot read error: {e}")
+                try:
+                    snapshots.append(self._read_snapshot(os.path.join(self.directory, 'metrics-dead.json')))
+                except FileNotFoundError:
+                    pass
+                except (OSError, ValueError) as e:
+                    print(f"Metrics snapshot read error: {e}")
+        except OSError as e:
+            print(f"Metrics snapshot read error: {e}")
+        return snapshots
+
+    def _merge(self, snapshots):
+        counters = {}
+        gauges = {}
+        histograms = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, value, mode in snapshot['gauges']:
+                key = (name, tuple(map(tuple, labels)))
+                if mode == 'max':
+                    gauges[key] = max(gauges.get(key, value), value)
+                else:
+                    gauges[key] = gauges.get(key, 0) + value
+            for name, labels, histogram in snapshot['histograms']:
+                key = (name, tuple(map(tuple, labels)))
+                merged = histograms.setdefault(key, {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+                merged['buckets'] = [a + b for a, b in zip(merged['buckets'], histogram['buckets'])]
+                merged['sum'] += histogram['sum']
+                merged['count'] += histogram['count']
+        return counters, gauges, histograms
+
+    def _combine(self, snapshots):
+        counters, _, histograms = self._merge(snapshots)
+        return {
+            'counters': [[name, [list(label) for label in labels], value] for (name, labels), value in counters.items()],
+            'gauges': [],
+            'histograms': [[name, [list(label) for label in labels], histogram] for (name, labels), histogram in histograms.items()],
+        }
 
-    if _edu_params_cache['params'] and (current_time - _edu_params_cache['timestamp']) < cache_duration:
-        return _edu_params_cache['params']
+    def render(self):
+        counters, gauges, histograms = self._merge(self._load_snapshots())
+
+        lines = []
+        for metric_type, samples in (('counter', counters), ('gauge', gauges)):
+            declared = set()
+            for (name, labels), value in sorted(samples.items()):
+                if name not in declared:
+                    declared.add(name)
+                    lines.append(f"# TYPE {name} {metric_type}")
+                lines.append(f"{name}{format_metric_labels(labels)} {value}")
+        declared = set()
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            for bound, count in zip(self.buckets, histogram['buckets']):
+                lines.append(f"{name}_bucket{format_metric_labels(labels + (('le', str(bound)),))} {count}")
+            lines.append(f"{name}_bucket{format_metric_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+            lines.append(f"{name}_sum{format_metric_labels(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{format_metric_labels(labels)} {histogram['count']}")
+        return '\n'.join(lines) + '\n'
+
+def format_metric_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+metrics = Metrics(METRICS_DIR, METRICS_LATENCY_BUCKETS, METRICS_FLUSH_INTERVAL)
+
+def collect_cache_metrics(name, backend, shared):
+    stats = backend.get_stats()
+    for kind, counters in stats['kinds'].items():
+        for counter in ('hits', 'misses', 'evictions'):
+            yield 'counter', f'cache_{counter}_total', {'cache': name, 'kind': kind}, counters[counter]
+    gauge_type = 'shared_gauge' if shared else 'gauge'
+    yield gauge_type, 'cache_entries', {'cache': name}, stats['entries']
+    yield gauge_type, 'cache_bytes', {'cache': name}, stats['bytes']
+
+def collect_component_metrics():
+    yield from collect_cache_metrics('metadata', cache, isinstance(cache, SQLiteCacheBackend))
+    yield from collect_cache_metrics('hls_segment', hls_segment_cache, False)
+
+    thumbnails = thumbnail_store.get_stats()
+    yield 'counter', 'cache_hits_total', {'cache': 'thumbnail', 'kind': 'memory'}, thumbnails['memoryHits']
+    yield 'counter', 'cache_hits_total', {'cache': 'thumbnail', 'kind': 'disk'}, thumbnails['diskHits']
+    yield 'counter', 'cache_misses_total', {'cache': 'thumbnail', 'kind': 'all'}, thumbnails['misses']
+    yield 'counter', 'cache_evictions_total', {'cache': 'thumbnail', 'kind': 'memory'}, thumbnails['evictions']
+    yield 'counter', 'cache_evictions_total', {'cache': 'thumbnail', 'kind': 'disk'}, thumbnails['diskEvictions']
+    yield 'gauge', 'cache_entries', {'cache': 'thumbnail'}, thumbnails['entries']
+    yield 'gauge', 'cache_bytes', {'cache': 'thumbnail'}, thumbnails['bytes']
+    yield 'shared_gauge', 'cache_disk_bytes', {'cache': 'thumbnail'}, thumbnails['diskBytes']
+
+    suggestions = suggestion_index.get_stats()
+    yield 'counter', 'cache_hits_total', {'cache': 'suggest', 'kind': 'exact'}, suggestions['hits']
+    yield 'counter', 'cache_hits_total', {'cache': 'suggest', 'kind': 'prefix'}, suggestions['prefixHits']
+    yield 'counter', 'cache_misses_total', {'cache': 'suggest', 'kind': 'all'}, suggestions['misses']
+    yield 'counter', 'cache_evictions_total', {'cache': 'suggest', 'kind': 'all'}, suggestions['evictions']
+    yield 'gauge', 'cache_entries', {'cache': 'suggest'}, suggestions['entries']
+
+    prefetch = prefetcher.get_stats()
+    for outcome in ('queued', 'completed', 'dropped', 'expired', 'failed'):
+        yield 'counter', 'prefetch_tasks_total', {'outcome': outcome}, prefetch[outcome]
+    yield 'gauge', 'prefetch_pending', {}, prefetch['pending']
+
+    for name, bulkhead in bulkheads.items():
+        stats = bulkhead.get_stats()
+        yield 'gauge', 'bulkhead_active', {'pool': name}, stats['active']
+        yield 'gauge', 'bulkhead_waiting', {'pool': name}, stats['waiting']
+        yield 'counter', 'bulkhead_rejections_total', {'pool': name}, stats['rejected']
+
+    with _inflight_lock:
+        yield 'gauge', 'single_flight_in_flight', {}, len(_inflight)
+    with _media_proxy_lock:
+        yield 'gauge', 'media_proxy_streams_in_flight', {}, sum(_media_proxy_clients.values())
+
+metrics.add_collector(collect_component_metrics)
+
+class RequestTrace:
+    # Spans of one request, appended from whichever thread ran them; tasks
+    # submitted through submit_with_deadline carry the trace with them.
+    def __init__(self):
+        self.started = time.time()
+        self.status = None
+        self.spans = []
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def start_span(self, name, parent, attrs):
+        return {'id': next(self.ids), 'parent': parent, 'name': name, 'start': time.time(),
+                'duration': None, 'outcome': 'ok', 'attrs': attrs}
+
+    def finish_span(self, span):
+        span['duration'] = time.time() - span['start']
+        with self.lock:
+            self.spans.append(span)
+
+    def get_waterfall(self):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span['start'])
+        return [dict(span['attrs'], id=span['id'], parent=span['parent'], name=span['name'],
+                     outcome=span['outcome'],
+                     startMs=round((span['start'] - self.started) * 1000, 1),
+                     durationMs=round(span['duration'] * 1000, 1))
+                for span in spans]
+
+    def get_server_timing(self):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span['start'])[:SERVER_TIMING_MAX_ENTRIES]
+        entries = []
+        for span in spans:
+            desc = span['attrs'].get('host') or span['outcome']
+            entries.append(f'{span["name"]};desc="{desc}";dur={span["duration"] * 1000:.1f}')
+        entries.append(f'total;dur={(time.time() - self.started) * 1000:.1f}')
+        return ', '.join(entries)
+
+@contextmanager
+def trace_span(name, **attrs):
+    # Yields the span's attribute dict so the caller can annotate it; a
+    # no-op outside a traced request. attrs['outcome'] overrides 'ok'.
+    trace = _current_trace.get()
+    if trace is None:
+        yield attrs
+        return
+    span = trace.start_span(name, _current_span.get(), attrs)
+    token = _current_span.set(span['id'])
+    try:
+        yield attrs
+        span['outcome'] = attrs.pop('outcome', 'ok')
+    except BaseException as e:
+        span['outcome'] = type(e).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        trace.finish_span(span)
+
+def traced(name):
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with trace_span(name) as span:
+                result = f(*args, **kwargs)
+                if result is None:
+                    span['outcome'] = 'empty'
+                return result
+        return wrapper
+    return decorator
+
+def record_upstream_result(host, started, status):
+    metrics.observe('upstream_request_duration_seconds', time.time() - started, host=host)
+    metrics.inc('upstream_requests_total', host=host, status=str(status))
+    if not isinstance(status, int) or status >= 500:
+        metrics.inc('upstream_errors_total', host=host, reason=str(status))
+
+def set_deadline(seconds):
+    deadline = time.time() + seconds
+    _request_deadline.set(deadline)
+    return deadline
+
+def get_remaining_budget():
+    deadline = _request_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+def budget_exhausted():
+    remaining = get_remaining_budget()
+    return remaining is not None and remaining <= 0
+
+def get_budget_timeout(timeout):
+    remaining = get_remaining_budget()
+    if remaining is None:
+        return timeout
+    if remaining <= 0:
+        raise DeadlineExceeded('request deadline exceeded')
+    if isinstance(timeout, tuple):
+        return tuple(min(value, remaining) for value in timeout)
+    return min(timeout, remaining)
+
+def submit_with_deadline(executor, fn, *args):
+    # Worker threads do not inherit context variables, so each task runs in
+    # a copy of the caller's context. A task that only gets a thread after
+    # the deadline has passed is skipped.
+    def run():
+        if budget_exhausted():
+            raise DeadlineExceeded(fn.__name__)
+        return fn(*args)
+
+    return executor.submit(contextvars.copy_context().run, run)
+
+def run_with_deadline(seconds, fn, *args):
+    # Background work gets a budget of its own, never a request's leftovers.
+    def run():
+        set_deadline(seconds)
+        return fn(*args)
+
+    return contextvars.Context().run(run)
+
+def wait_before_retry(attempt):
+    backoff = UPSTREAM_RETRY_BACKOFF * (2 ** attempt)
+    remaining = get_remaining_budget()
+    if remaining is not None and remaining <= backoff:
+        return False
+    time.sleep(backoff)
+    return True
+
+def upstream_get(url, timeout, retries=UPSTREAM_RETRIES, **kwargs):
+    # Connect and read timeouts shrink to the remaining budget, and a retry
+    # is only attempted while the budget still covers its backoff.
+    host = urllib.parse.urlparse(url).hostname or ''
+    for attempt in range(retries + 1):
+        last = attempt == retries
+        if attempt:
+            metrics.inc('upstream_retries_total', host=host)
+        attempt_timeout = get_budget_timeout(timeout)
+        error = None
+        with trace_span('upstream', host=host, attempt=attempt) as span:
+            started = time.time()
+            metrics.add_gauge('upstream_requests_in_flight', 1, host=host)
+            try:
+                res = http_session.get(url, timeout=attempt_timeout, **kwargs)
+                status = res.status_code
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+                status = type(e).__name__
+            finally:
+                metrics.add_gauge('upstream_requests_in_flight', -1, host=host)
+            record_upstream_result(host, started, status)
+            span['status'] = status
+            if error is not None:
+                span['outcome'] = 'error'
+        if error is not None:
+            if last or not wait_before_retry(attempt):
+                raise error
+            continue
+        if res.status_code not in UPSTREAM_RETRY_STATUSES or last or not wait_before_retry(attempt):
+            return res
+        res.close()
+
+def single_flight(key, fn):
+    with _inflight_lock:
+        future = _inflight.get(key)
+        is_leader = future is None
+        if is_leader:
+            future = Future()
+            _inflight[key] = future
+
+    if not is_leader:
+        # A follower that runs out of budget gets None, the same "no answer"
+        # every loader returns on failure.
+        remaining = get_remaining_budget()
+        try:
+            return future.result(timeout=None if remaining is None else max(0, remaining))
+        except TimeoutError:
+            return None
 
     try:
-        res = http_session.get(EDU_CONFIG_URL, headers=get_random_headers(), timeout=3)
-        res.raise_for_status()
-        data = res.json()
+        result = fn()
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+
+def cached(kind, key, loader):
+    value = cache.get(kind, key)
+    if value is not None:
+        return value
+    if is_known_missing(kind, key):
+        return None
+    return single_flight(f"cache:{kind}:{key}", lambda: load_and_cache(kind, key, loader))
+
+def load_and_cache(kind, key, loader):
+    # Another flight may have filled the entry while this one was queued.
+    value = cache.peek(kind, key)
+    if value is not None:
+        return value
+    value = loader()
+    if value is NOT_FOUND:
+        cache.set('missing', f"{kind}:{key}", True)
+        return None
+    # Empty results are indistinguishable from upstream failures, so only
+    # real answers are cached.
+    if value:
+        cache.set(kind, key, value)
+    return value
+
+def is_known_missing(kind, key):
+    return cache.peek('missing', f"{kind}:{key}") is not None
+
+def cached_swr(kind, key, loader, wait_on_miss=True):
+    entry = cache.get(kind, key)
+    if entry is None:
+        if wait_on_miss and not swr_recently_failed(kind, key):
+            return single_flight(f"swr:{kind}:{key}", lambda: refresh_swr(kind, key, loader))
+        schedule_swr_refresh(kind, key, loader)
+        return None
+
+    if time.time() - entry['fetched_at'] >= CACHE_TTLS.get(kind, 300) * SWR_REFRESH_AHEAD:
+        schedule_swr_refresh(kind, key, loader)
+    return entry['value']
+
+def swr_recently_failed(kind, key):
+    with _swr_lock:
+        return time.time() - _swr_failed_at.get(f"{kind}:{key}", 0) < SWR_RETRY_INTERVAL
+
+def refresh_swr(kind, key, loader):
+    value = loader()
+    if value:
+        cache.set(kind, key, {'value': value, 'fetched_at': time.time()}, ttl=CACHE_STALE_TTLS.get(kind, 86400))
+    else:
+        # Keep serving the last good value; just hold off the next attempt.
+        with _swr_lock:
+            _swr_failed_at[f"{kind}:{key}"] = time.time()
+    return value
+
+def schedule_swr_refresh(kind, key, loader):
+    refresh_key = f"{kind}:{key}"
+    if swr_recently_failed(kind, key):
+        return
+    with _swr_lock:
+        if refresh_key in _swr_scheduled:
+            return
+        _swr_scheduled.add(refresh_key)
+
+    def run():
+        try:
+            run_with_deadline(BACKGROUND_DEADLINE, single_flight, f"swr:{kind}:{key}",
+                              lambda: refresh_swr(kind, key, loader))
+        except Exception as e:
+            print(f"Background refresh of {refresh_key} failed: {e}")
+        finally:
+            with _swr_lock:
+                _swr_scheduled.discard(refresh_key)
+
+    _refresh_executor.submit(run)
+
+def fetch_edu_params():
+    try:
+        with bulkheads['edu']:
+            res = upstream_get(EDU_CONFIG_URL, headers=get_random_headers(), timeout=3)
+            res.raise_for_status()
+            data = res.json()
         params = data.get('params', '')
         if params.startswith('?'):
             params = params[1:]
-        params = params.replace('&amp;', '&')
-        _edu_params_cache['params'] = params
-        _edu_params_cache['timestamp'] = current_time
-        return params
+        return params.replace('&amp;', '&')
     except Exception as e:
         print(f"Failed to fetch edu params: {e}")
-        return "autoplay=1&rel=0&modestbranding=1"
+        return None
+
+def get_edu_params():
+    params = cached_swr('edu_params', 'params', fetch_edu_params)
+    return params or "autoplay=1&rel=0&modestbranding=1"
 
 def safe_request(url, timeout=(2, 5)):
     try:
-        res = http_session.get(url, headers=get_random_headers(), timeout=timeout)
+        res = upstream_get(url, headers=get_random_headers(), timeout=timeout)
         res.raise_for_status()
         return res.json()
     except:
         return None
 
-def request_invidious_api(path, timeout=(2, 5)):
-    random_instances = random.sample(INVIDIOUS_INSTANCES, min(3, len(INVIDIOUS_INSTANCES)))
-    for instance in random_instances:
-        try:
+def get_instance_state(stats, current_time):
+    if stats['opened_at'] is None:
+        return 'closed'
+    if current_time - stats['opened_at'] >= INSTANCE_COOLDOWN:
+        return 'half_open'
+    return 'open'
+
+def get_instance_score(stats):
+    total = stats['successes'] + stats['failures']
+    success_rate = (stats['successes'] + 1) / (total + 2)
+    latency = stats['latency'] if stats['latency'] is not None else 1.0
+    return success_rate / max(latency, 0.05)
+
+def record_instance_result(instance, ok, latency=None):
+    with _instance_lock:
+        stats = _instance_stats[instance]
+        if ok:
+            stats['successes'] += 1
+            stats['consecutive_failures'] = 0
+            stats['opened_at'] = None
+            if latency is not None:
+                if stats['latency'] is None:
+                    stats['latency'] = latency
+                else:
+                    stats['latency'] += INSTANCE_LATENCY_ALPHA * (latency - stats['latency'])
+        else:
+            stats['failures'] += 1
+            stats['consecutive_failures'] += 1
+            if stats['consecutive_failures'] >= INSTANCE_FAILURE_THRESHOLD:
+                stats['opened_at'] = time.time()
+
+def rank_invidious_instances(count=3):
+    current_time = time.time()
+    closed = []
+    half_open = []
+    opened = []
+    with _instance_lock:
+        instances = list(INVIDIOUS_INSTANCES)
+        random.shuffle(instances)
+        for instance in instances:
+            stats = _instance_stats[instance]
+            state = get_instance_state(stats, current_time)
+            if state == 'closed':
+                closed.append(instance)
+            elif state == 'half_open':
+                half_open.append(instance)
+            else:
+                opened.append(instance)
+        closed.sort(key=lambda i: get_instance_score(_instance_stats[i]), reverse=True)
+
+        ranked = closed[:count]
+        if half_open:
+            # One probe per call; re-arming the cool-down keeps concurrent
+            # requests from all probing the same instance at once.
+            probe = half_open[0]
+            _instance_stats[probe]['opened_at'] = current_time
+            ranked.insert(1 if ranked else 0, probe)
+            ranked = ranked[:count]
+        if not ranked:
+            opened.sort(key=lambda i: _instance_stats[i]['opened_at'])
+            ranked = opened[:count]
+    return ranked
+
+def get_instance_scoreboard():
+    current_time = time.time()
+    board = []
+    with _instance_lock:
+        for instance in INVIDIOUS_INSTANCES:
+            stats = _instance_stats[instance]
+            total = stats['successes'] + stats['failures']
+            board.append({
+                'instance': instance,
+                'state': get_instance_state(stats, current_time),
+                'score': round(get_instance_score(stats), 3),
+                'successes': stats['successes'],
+                'failures': stats['failures'],
+                'consecutiveFailures': stats['consecutive_failures'],
+                'successRate': round(stats['successes'] / total, 3) if total else None,
+                'latencyMs': round(stats['latency'] * 1000) if stats['latency'] is not None else None
+            })
+    board.sort(key=lambda entry: entry['score'], reverse=True)
+    return board
+
+def get_hedge_delay():
+    if HEDGE_DELAY > 0:
+        return HEDGE_DELAY
+    with _instance_lock:
+        samples = sorted(_latency_samples)
+    if len(samples) < 10:
+        return 1.0
+    return max(HEDGE_MIN_DELAY, samples[int(len(samples) * 0.9) - 1])
+
+def take_hedge_token():
+    with _instance_lock:
+        if _hedge_budget['tokens'] < 1:
+            return False
+        _hedge_budget['tokens'] -= 1
+        return True
+
+def fetch_invidious_instance(instance, path, timeout, cancelled=None):
+    try:
+        with bulkheads['invidious']:
+            started = time.time()
             url = instance + 'api/v1' + path
-            res = http_session.get(url, headers=get_random_headers(), timeout=timeout)
-            if res.status_code == 200:
-                return res.json()
-        except:
-            continue
+            # Failing over to the next instance is the retry here.
+            res = upstream_get(url, headers=get_random_headers(), timeout=timeout, retries=0, stream=True)
+            if cancelled is not None and cancelled.is_set():
+                res.close()
+                return None
+            if res.status_code == 404:
+                try:
+                    is_error_json = isinstance(res.json().get('error'), str)
+                except Exception:
+                    is_error_json = False
+                res.close()
+                # Invidious answers a missing resource with {"error": ...};
+                # a bare 404 means the API itself is missing or broken. Either
+                # way a fast 404 must not improve the instance's latency score.
+                record_instance_result(instance, is_error_json)
+                return NOT_FOUND if is_error_json else None
+            if res.status_code != 200:
+                res.close()
+                record_instance_result(instance, False, time.time() - started)
+                return None
+            data = res.json()
+            latency = time.time() - started
+        record_instance_result(instance, True, latency)
+        with _instance_lock:
+            _latency_samples.append(latency)
+        return data
+    except (BulkheadFull, DeadlineExceeded):
+        # Saturated or out of time locally; says nothing about the instance's health.
+        return None
+    except:
+        if (cancelled is None or not cancelled.is_set()) and not budget_exhausted():
+            record_instance_result(instance, False)
+        return None
+
+def request_invidious_api_hedged(path, instances, timeout):
+    remaining = list(instances)
+    cancelled = threading.Event()
+    pending = {submit_with_deadline(_hedge_executor, fetch_invidious_instance, remaining.pop(0), path, timeout, cancelled)}
+    delay = get_hedge_delay()
+    can_hedge = True
+    not_found_votes = 0
+    try:
+        while pending:
+            done, pending = wait(pending, timeout=delay if remaining and can_hedge else None,
+                                 return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    data = future.result()
+                except DeadlineExceeded:
+                    return None
+                # A not-found answer never wins the race; it only counts
+                # towards the quorum while the other instances carry on.
+                if data is NOT_FOUND:
+                    not_found_votes += 1
+                    if not_found_votes >= INVIDIOUS_NOT_FOUND_QUORUM:
+                        return NOT_FOUND
+                elif data is not None:
+                    return data
+            if not remaining:
+                continue
+            if done:
+                pending.add(submit_with_deadline(_hedge_executor, fetch_invidious_instance, remaining.pop(0), path, timeout, cancelled))
+            elif take_hedge_token():
+                pending.add(submit_with_deadline(_hedge_executor, fetch_invidious_instance, remaining.pop(0), path, timeout, cancelled))
+            else:
+                can_hedge = False
+        return None
+    finally:
+        cancelled.set()
+        for future in pending:
+            future.cancel()
+
+@traced('invidious')
+def request_invidious_api(path, timeout=(2, 5), hedge=False, not_found=None):
+    data = single_flight(f"invidious:{path}", lambda: request_invidious_api_uncoalesced(path, timeout, hedge))
+    return not_found if data is NOT_FOUND else data
+
+def request_invidious_api_uncoalesced(path, timeout, hedge):
+    instances = rank_invidious_instances()
+    with _instance_lock:
+        _hedge_budget['tokens'] = min(HEDGE_BURST, _hedge_budget['tokens'] + HEDGE_MAX_RATIO)
+
+    if hedge and len(instances) > 1:
+        return request_invidious_api_hedged(path, instances, timeout)
+
+    not_found_votes = 0
+    for instance in instances:
+        data = fetch_invidious_instance(instance, path, timeout)
+        if data is NOT_FOUND:
+            not_found_votes += 1
+            if not_found_votes >= INVIDIOUS_NOT_FOUND_QUORUM:
+                return NOT_FOUND
+        elif data is not None:
+            return data
     return None
 
+def normalize_search_query(query):
+    return ' '.join(query.split()).casefold()
+
+@traced('youtube_search')
 def get_youtube_search(query, max_results=20):
     if YOUTUBE_API_KEY:
-        url = f"https://www.googleapis.com/youtube/v3/search?part=snippet&type=video&q={urllib.parse.quote(query)}&maxResults={max_results}&key={YOUTUBE_API_KEY}"
+        key = f"youtube:{max_results}:{normalize_search_query(query)}"
+        results = cached('search', key, lambda: fetch_youtube_search(query, max_results))
+        if results is not None:
+            return results
+
+    return invidious_search(query)
+
+def fetch_youtube_search(query, max_results=20):
+    if YOUTUBE_API_KEY:
+        url = f"{YOUTUBE_API_BASE}/search?part=snippet&type=video&q={urllib.parse.quote(query)}&maxResults={max_results}&key={YOUTUBE_API_KEY}"
         try:
-            res = http_session.get(url, timeout=5)
+            res = upstream_get(url, timeout=5)
             res.raise_for_status()
             data = res.json()
             results = []
@@ -130,13 +1591,90 @@ def get_youtube_search(query, max_results=20):
                     'views': '',
                     'length': ''
                 })
-            return results
+            return enrich_youtube_results(results)
         except Exception as e:
             print(f"YouTube API error: {e}")
+    return None
 
-    return invidious_search(query)
+def parse_iso8601_duration(duration):
+    match = ISO8601_DURATION.fullmatch(duration or '')
+    if not match or not any(match.groups()):
+        return 0
+    days, hours, minutes, seconds = (int(value or 0) for value in match.groups())
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+def fetch_youtube_video_stats(video_ids):
+    stats = {}
+    for start in range(0, len(video_ids), YOUTUBE_VIDEOS_BATCH_SIZE):
+        batch = video_ids[start:start + YOUTUBE_VIDEOS_BATCH_SIZE]
+        url = f"{YOUTUBE_API_BASE}/videos?part=statistics,contentDetails&id={','.join(batch)}&key={YOUTUBE_API_KEY}"
+        try:
+            res = upstream_get(url, timeout=5)
+            res.raise_for_status()
+            data = res.json()
+        except Exception as e:
+            print(f"YouTube API videos.list error: {e}")
+            continue
+        for item in data.get('items', []):
+            view_count = item.get('statistics', {}).get('viewCount')
+            length_seconds = parse_iso8601_duration(item.get('contentDetails', {}).get('duration'))
+            stats[item.get('id', '')] = {
+                'views': f"{int(view_count):,} 回視聴" if view_count else '',
+                'length': str(datetime.timedelta(seconds=length_seconds)) if length_seconds else ''
+            }
+    return stats
+
+def get_youtube_video_stats(video_ids):
+    stats = {}
+    missing = []
+    for video_id in dict.fromkeys(video_ids):
+        cached_stats = cache.get('video_stats', video_id)
+        if cached_stats is not None:
+            stats[video_id] = cached_stats
+        else:
+            missing.append(video_id)
+
+    if missing:
+        fetched = fetch_youtube_video_stats(missing)
+        for video_id, video_stats in fetched.items():
+            cache.set('video_stats', video_id, video_stats)
+        stats.update(fetched)
+    return stats
+
+def enrich_youtube_results(results):
+    # search.list has no statistics or contentDetails; one batched
+    # videos.list call fills in views and length for the whole page.
+    video_ids = [item['id'] for item in results if item['type'] == 'video' and item['id']]
+    stats = get_youtube_video_stats(video_ids) if video_ids else {}
+    for item in results:
+        item.update(stats.get(item['id'], {}))
+    return results
 
 def invidious_search(query, page=1):
+    key = f"invidious:{page}:{normalize_search_query(query)}"
+    return cached('search', key, lambda: fetch_invidious_search(query, page))
+
+@traced('search')
+def get_search_page(query, page):
+    return get_youtube_search(query) if page == 1 else invidious_search(query, page)
+
+def prefetch_page(loader, *args):
+    # Warms the next page of a paginated listing; skipped rather than queued
+    # when every prefetch slot is busy.
+    if not _page_prefetch_slots.acquire(blocking=False):
+        return
+
+    def run():
+        try:
+            run_with_deadline(BACKGROUND_DEADLINE, loader, *args)
+        except Exception as e:
+            print(f"Page prefetch error: {e}")
+        finally:
+            _page_prefetch_slots.release()
+
+    _page_prefetch_executor.submit(run)
+
+def fetch_invidious_search(query, page=1):
     path = f"/search?q={urllib.parse.quote(query)}&page={page}&hl=jp"
     data = request_invidious_api(path)
 
@@ -183,15 +1721,22 @@ def invidious_search(query, page=1):
 
     return results
 
+@traced('video_info')
 def get_video_info(video_id):
+    return cached('video', video_id, lambda: fetch_video_info(video_id))
+
+def fetch_video_info(video_id):
     path = f"/videos/{urllib.parse.quote(video_id)}"
-    data = request_invidious_api(path, timeout=(5, 15))
+    data = request_invidious_api(path, timeout=(5, 15), hedge=True, not_found=NOT_FOUND)
+    if data is NOT_FOUND:
+        return NOT_FOUND
 
     if not data:
         try:
-            res = http_session.get(f"{EDU_VIDEO_API}{video_id}", headers=get_random_headers(), timeout=(2, 6))
-            res.raise_for_status()
-            edu_data = res.json()
+            with bulkheads['edu']:
+                res = upstream_get(f"{EDU_VIDEO_API}{video_id}", headers=get_random_headers(), timeout=(2, 6))
+                res.raise_for_status()
+                edu_data = res.json()
 
             related_videos = []
             for item in edu_data.get('related', [])[:20]:
@@ -283,9 +1828,15 @@ def get_video_info(video_id):
         'audioUrl': audio_url
     }
 
+@traced('playlist_info')
 def get_playlist_info(playlist_id):
+    return cached('playlist', playlist_id, lambda: fetch_playlist_info(playlist_id))
+
+def fetch_playlist_info(playlist_id):
     path = f"/playlists/{urllib.parse.quote(playlist_id)}"
-    data = request_invidious_api(path, timeout=(5, 15))
+    data = request_invidious_api(path, timeout=(5, 15), hedge=True, not_found=NOT_FOUND)
+    if data is NOT_FOUND:
+        return NOT_FOUND
 
     if not data:
         return None
@@ -314,9 +1865,15 @@ def get_playlist_info(playlist_id):
         'videos': videos
     }
 
+@traced('channel_info')
 def get_channel_info(channel_id):
+    return cached('channel', channel_id, lambda: fetch_channel_info(channel_id))
+
+def fetch_channel_info(channel_id):
     path = f"/channels/{urllib.parse.quote(channel_id)}"
-    data = request_invidious_api(path, timeout=(5, 15))
+    data = request_invidious_api(path, timeout=(5, 15), hedge=True, not_found=NOT_FOUND)
+    if data is NOT_FOUND:
+        return NOT_FOUND
 
     if not data:
         return None
@@ -354,7 +1911,12 @@ def get_channel_info(channel_id):
         'videoCount': data.get('videoCount', 0)
     }
 
+@traced('channel_videos')
 def get_channel_videos(channel_id, continuation=None):
+    return cached('channel_videos', f"{channel_id}:{continuation or ''}",
+                  lambda: fetch_channel_videos(channel_id, continuation))
+
+def fetch_channel_videos(channel_id, continuation=None):
     path = f"/channels/{urllib.parse.quote(channel_id)}/videos"
     if continuation:
         path += f"?continuation={urllib.parse.quote(continuation)}"
@@ -383,9 +1945,21 @@ def get_channel_videos(channel_id, continuation=None):
         'continuation': data.get('continuation', '')
     }
 
+@traced('stream_url')
 def get_stream_url(video_id):
-    edu_params = get_edu_params()
-    urls = {
+    urls = build_stream_urls(video_id, get_edu_params())
+    if is_known_missing('video', video_id):
+        return urls
+    resolved = cache.get('streams', video_id)
+    if resolved is None:
+        resolved = single_flight(f"stream:{video_id}", lambda: resolve_stream_urls(video_id))
+    # None when this request's budget ran out waiting on another request.
+    if resolved:
+        urls.update(resolved)
+    return urls
+
+def build_stream_urls(video_id, edu_params):
+    return {
         'primary': None,
         'fallback': None,
         'm3u8': None,
@@ -393,44 +1967,103 @@ def get_stream_url(video_id):
         'education': f"https://www.youtubeeducation.com/embed/{video_id}?{edu_params}"
     }
 
+def resolve_stream_urls(video_id):
+    resolved = cache.peek('streams', video_id)
+    if resolved is not None:
+        return resolved
+
+    formats_future = submit_with_deadline(_stream_executor, fetch_stream_formats, video_id)
+    m3u8_future = submit_with_deadline(_stream_executor, fetch_m3u8_url, video_id)
+    resolved = {'primary': None, 'fallback': None, 'm3u8': None}
     try:
-        res = http_session.get(f"{STREAM_API}{video_id}", headers=get_random_headers(), timeout=(3, 6))
-        if res.status_code == 200:
-            data = res.json()
-            formats = data.get('formats', [])
+        formats = formats_future.result()
+        m3u8 = m3u8_future.result()
+    except DeadlineExceeded:
+        return resolved
+    for part in (formats, m3u8):
+        if part:
+            resolved.update(part)
+
+    # Caching a half-failed lookup would hide the other source's URLs for
+    # the whole lifetime of the one that did resolve.
+    ttl = get_stream_cache_ttl(resolved.values())
+    if formats is not None and m3u8 is not None and ttl > 0 and any(resolved.values()):
+        cache.set('streams', video_id, resolved, ttl=ttl)
+    return resolved
+
+# Both stream lookups return None when the upstream could not be asked or
+# failed, and a dict (possibly of None URLs) when it answered.
+def fetch_stream_formats(video_id):
+    try:
+        with bulkheads['streams']:
+            res = upstream_get(f"{STREAM_API}{video_id}", headers=get_random_headers(), timeout=(3, 6))
+            data = res.json() if res.status_code == 200 else None
+    except:
+        return None
+    if data is None:
+        return None
 
-            for fmt in formats:
-                if fmt.get('itag') == '18':
-                    urls['primary'] = fmt.get('url')
-                    break
+    urls = {'primary': None, 'fallback': None}
+    formats = data.get('formats', [])
+    for fmt in formats:
+        if fmt.get('itag') == '18':
+            urls['primary'] = fmt.get('url')
+            break
 
-            if not urls['primary']:
-                for fmt in formats:
-                    if fmt.get('url') and fmt.get('vcodec') != 'none':
-                        urls['fallback'] = fmt.get('url')
-                        break
-    except:
-        pass
+    if not urls['primary']:
+        for fmt in formats:
+            if fmt.get('url') and fmt.get('vcodec') != 'none':
+                urls['fallback'] = fmt.get('url')
+                break
+    return urls
 
+def fetch_m3u8_url(video_id):
     try:
-        res = http_session.get(f"{M3U8_API}{video_id}", headers=get_random_headers(), timeout=(3, 6))
-        if res.status_code == 200:
-            data = res.json()
-            m3u8_formats = data.get('m3u8_formats', [])
-            if m3u8_formats:
-                best = max(m3u8_formats, key=lambda x: int(x.get('resolution', '0x0').split('x')[-1] or 0))
-                urls['m3u8'] = best.get('url')
+        with bulkheads['streams']:
+            res = upstream_get(f"{M3U8_API}{video_id}", headers=get_random_headers(), timeout=(3, 6))
+            data = res.json() if res.status_code == 200 else None
     except:
-        pass
+        return None
+    if data is None:
+        return None
 
-    return urls
+    m3u8_formats = data.get('m3u8_formats', [])
+    if not m3u8_formats:
+        return {'m3u8': None}
+    best = max(m3u8_formats, key=lambda x: int(x.get('resolution', '0x0').split('x')[-1] or 0))
+    return {'m3u8': best.get('url')}
+
+def get_url_expiry(url):
+    # googlevideo URLs carry expire either as a query parameter or, for
+    # HLS manifests, as an /expire/<timestamp>/ path segment.
+    parsed = urllib.parse.urlparse(url)
+    expire = urllib.parse.parse_qs(parsed.query).get('expire', [None])[0]
+    if expire is None:
+        match = STREAM_EXPIRE_PATH.search(parsed.path)
+        expire = match.group(1) if match else None
+    try:
+        return float(expire) if expire is not None else None
+    except ValueError:
+        return None
+
+def get_stream_cache_ttl(urls):
+    expiries = [expiry for expiry in (get_url_expiry(url) for url in urls if url) if expiry is not None]
+    if not expiries:
+        return STREAM_URL_DEFAULT_TTL
+    return min(min(expiries) - time.time() - STREAM_URL_SAFETY_MARGIN, STREAM_URL_MAX_TTL)
+
+@traced('comments')
+def get_comments(video_id, continuation=None):
+    return cached('comments', f"{video_id}:{continuation or ''}", lambda: fetch_comments(video_id, continuation))
 
-def get_comments(video_id):
+def fetch_comments(video_id, continuation=None):
     path = f"/comments/{urllib.parse.quote(video_id)}?hl=jp"
+    if continuation:
+        path += f"&continuation={urllib.parse.quote(continuation)}"
     data = request_invidious_api(path)
 
     if not data:
-        return []
+        return None
 
     comments = []
     for item in data.get('comments', []):
@@ -440,25 +2073,36 @@ def get_comments(video_id):
             'author': item.get('author', ''),
             'authorThumbnail': author_thumbnail,
             'authorId': item.get('authorId', ''),
-            'content': item.get('contentHtml', '').replace('\n', '<br>'),
+            # Plain text; the template escapes it. contentHtml is
+            # third-party markup and is never rendered.
+            'content': item.get('content', ''),
             'likes': item.get('likeCount', 0),
             'published': item.get('publishedText', '')
         })
 
-    return comments
+    return {
+        'comments': comments,
+        'continuation': data.get('continuation', '')
+    }
 
-def get_trending():
-    cache_duration = 300
-    current_time = time.time()
+def get_comments_html(video_id, continuation=None):
+    page = get_comments(video_id, continuation)
+    if not page:
+        return None
 
-    if _trending_cache['data'] and (current_time - _trending_cache['timestamp']) < cache_duration:
-        return _trending_cache['data']
+    key = f"{video_id}:{continuation or ''}"
+    html = cache.get('comments_html', key)
+    if html is None:
+        html = render_template('watch_comments.html', video_id=video_id, **page)
+        cache.set('comments_html', key, html)
+    return html
 
+def fetch_trending():
     path = "/popular"
     data = request_invidious_api(path, timeout=(2, 4))
 
+    results = []
     if data:
-        results = []
         for item in data[:24]:
             if item.get('type') in ['video', 'shortVideo']:
                 results.append({
@@ -470,33 +2114,328 @@ def get_trending():
                     'published': item.get('publishedText', ''),
                     'views': item.get('viewCountText', '')
                 })
-        if results:
-            _trending_cache['data'] = results
-            _trending_cache['timestamp'] = current_time
-            return results
+    return results
 
-    default_videos = [
-        {'type': 'video', 'id': 'dQw4w9WgXcQ', 'title': 'Rick Astley - Never Gonna Give You Up', 'author': 'Rick Astley', 'thumbnail': 'https://i.ytimg.com/vi/dQw4w9WgXcQ/hqdefault.jpg', 'published': '', 'views': '17億 回視聴'},
-        {'type': 'video', 'id': 'kJQP7kiw5Fk', 'title': 'Luis Fonsi - Despacito ft. Daddy Yankee', 'author': 'Luis Fonsi', 'thumbnail': 'https://i.ytimg.com/vi/kJQP7kiw5Fk/hqdefault.jpg', 'published': '', 'views': '80億 回視聴'},
-        {'type': 'video', 'id': 'JGwWNGJdvx8', 'title': 'Ed Sheeran - Shape of You', 'author': 'Ed Sheeran', 'thumbnail': 'https://i.ytimg.com/vi/JGwWNGJdvx8/hqdefault.jpg', 'published': '', 'views': '64億 回視聴'},
-        {'type': 'video', 'id': 'RgKAFK5djSk', 'title': 'Wiz Khalifa - See You Again ft. Charlie Puth', 'author': 'Wiz Khalifa', 'thumbnail': 'https://i.ytimg.com/vi/RgKAFK5djSk/hqdefault.jpg', 'published': '', 'views': '60億 回視聴'},
-        {'type': 'video', 'id': 'OPf0YbXqDm0', 'title': 'Mark Ronson - Uptown Funk ft. Bruno Mars', 'author': 'Mark Ronson', 'thumbnail': 'https://i.ytimg.com/vi/OPf0YbXqDm0/hqdefault.jpg', 'published': '', 'views': '50億 回視聴'},
-        {'type': 'video', 'id': '9bZkp7q19f0', 'title': 'PSY - Gangnam Style', 'author': 'PSY', 'thumbnail': 'https://i.ytimg.com/vi/9bZkp7q19f0/hqdefault.jpg', 'published': '', 'views': '50億 回視聴'},
-        {'type': 'video', 'id': 'XqZsoesa55w', 'title': 'Baby Shark Dance', 'author': 'Pinkfong', 'thumbnail': 'https://i.ytimg.com/vi/XqZsoesa55w/hqdefault.jpg', 'published': '', 'views': '150億 回視聴'},
-        {'type': 'video', 'id': 'fJ9rUzIMcZQ', 'title': 'Queen - Bohemian Rhapsody', 'author': 'Queen Official', 'thumbnail': 'https://i.ytimg.com/vi/fJ9rUzIMcZQ/hqdefault.jpg', 'published': '', 'views': '16億 回視聴'},
-    ]
-    return default_videos
+# Shown on a cold start or while /popular is unreachable.
+DEFAULT_TRENDING_VIDEOS = [
+    {'type': 'video', 'id': 'dQw4w9WgXcQ', 'title': 'Rick Astley - Never Gonna Give You Up', 'author': 'Rick Astley', 'thumbnail': 'https://i.ytimg.com/vi/dQw4w9WgXcQ/hqdefault.jpg', 'published': '', 'views': '17億 回視聴'},
+    {'type': 'video', 'id': 'kJQP7kiw5Fk', 'title': 'Luis Fonsi - Despacito ft. Daddy Yankee', 'author': 'Luis Fonsi', 'thumbnail': 'https://i.ytimg.com/vi/kJQP7kiw5Fk/hqdefault.jpg', 'published': '', 'views': '80億 回視聴'},
+    {'type': 'video', 'id': 'JGwWNGJdvx8', 'title': 'Ed Sheeran - Shape of You', 'author': 'Ed Sheeran', 'thumbnail': 'https://i.ytimg.com/vi/JGwWNGJdvx8/hqdefault.jpg', 'published': '', 'views': '64億 回視聴'},
+    {'type': 'video', 'id': 'RgKAFK5djSk', 'title': 'Wiz Khalifa - See You Again ft. Charlie Puth', 'author': 'Wiz Khalifa', 'thumbnail': 'https://i.ytimg.com/vi/RgKAFK5djSk/hqdefault.jpg', 'published': '', 'views': '60億 回視聴'},
+    {'type': 'video', 'id': 'OPf0YbXqDm0', 'title': 'Mark Ronson - Uptown Funk ft. Bruno Mars', 'author': 'Mark Ronson', 'thumbnail': 'https://i.ytimg.com/vi/OPf0YbXqDm0/hqdefault.jpg', 'published': '', 'views': '50億 回視聴'},
+    {'type': 'video', 'id': '9bZkp7q19f0', 'title': 'PSY - Gangnam Style', 'author': 'PSY', 'thumbnail': 'https://i.ytimg.com/vi/9bZkp7q19f0/hqdefault.jpg', 'published': '', 'views': '50億 回視聴'},
+    {'type': 'video', 'id': 'XqZsoesa55w', 'title': 'Baby Shark Dance', 'author': 'Pinkfong', 'thumbnail': 'https://i.ytimg.com/vi/XqZsoesa55w/hqdefault.jpg', 'published': '', 'views': '150億 回視聴'},
+    {'type': 'video', 'id': 'fJ9rUzIMcZQ', 'title': 'Queen - Bohemian Rhapsody', 'author': 'Queen Official', 'thumbnail': 'https://i.ytimg.com/vi/fJ9rUzIMcZQ/hqdefault.jpg', 'published': '', 'views': '16億 回視聴'},
+]
 
+@traced('trending')
+def get_trending():
+    # Never block the index page on /popular: serve the last good list (or
+    # the built-in defaults on a cold start) and refresh in the background.
+    results = cached_swr('trending', 'popular', fetch_trending, wait_on_miss=False)
+    if results:
+        return results
+    return DEFAULT_TRENDING_VIDEOS
+
+@traced('suggestions')
 def get_suggestions(keyword):
+    keyword = ' '.join(keyword.split()).casefold()
+    if not keyword:
+        return []
+
+    suggestions = suggestion_index.lookup(keyword)
+    if suggestions is not None:
+        return suggestions
+
+    suggestions = single_flight(f"suggest:{keyword}", lambda: fetch_suggestions(keyword))
+    if suggestions is None:
+        return None
+    suggestion_index.store(keyword, suggestions)
+    return suggestions
+
+def fetch_suggestions(keyword):
     try:
         url = f"https://suggestqueries.google.com/complete/search?client=firefox&ds=yt&q={urllib.parse.quote(keyword)}"
-        res = http_session.get(url, headers=get_random_headers(), timeout=2)
-        if res.status_code == 200:
-            data = res.json()
+        with bulkheads['suggest']:
+            res = upstream_get(url, headers=get_random_headers(), timeout=2)
+            data = res.json() if res.status_code == 200 else None
+        if data is not None:
             return data[1] if len(data) > 1 else []
     except:
         pass
-    return []
+    return None
+
+def get_empty_stream_urls(video_id):
+    edu_params_entry = cache.get('edu_params', 'params')
+    edu_params = edu_params_entry['value'] if edu_params_entry else "autoplay=1&rel=0&modestbranding=1"
+    return build_stream_urls(video_id, edu_params)
+
+def submit_watch_fetches(video_id, playlist_id=''):
+    futures = {
+        submit_with_deadline(_page_executor, get_video_info, video_id): 'video',
+        submit_with_deadline(_page_executor, get_stream_url, video_id): 'streams'
+    }
+    if playlist_id:
+        futures[submit_with_deadline(_page_executor, get_playlist_info, playlist_id)] = 'playlist'
+    return futures
+
+def iter_watch_results(video_id, futures, deadline):
+    try:
+        for future in as_completed(futures, timeout=max(0, deadline - time.time())):
+            name = futures[future]
+            try:
+                yield name, future.result()
+            except Exception as e:
+                print(f"Watch {name} fetch error: {e}")
+    except TimeoutError:
+        pending = [name for future, name in futures.items() if not future.done()]
+        print(f"Watch page deadline exceeded for {video_id}: {', '.join(pending)}")
+        for future in futures:
+            future.cancel()
+
+def fetch_watch_data(video_id, playlist_id=''):
+    results = {
+        'video': None,
+        'streams': get_empty_stream_urls(video_id),
+        'playlist': None
+    }
+    deadline = set_deadline(WATCH_PAGE_DEADLINE)
+    futures = submit_watch_fetches(video_id, playlist_id)
+    for name, value in iter_watch_results(video_id, futures, deadline):
+        if value is not None:
+            results[name] = value
+    return results
+
+def get_playlist_context(playlist):
+    if not playlist:
+        return {'playlist_videos': [], 'playlist_title': ''}
+    return {'playlist_videos': playlist.get('videos', []), 'playlist_title': playlist.get('title', '')}
+
+def render_playlist_slot(playlist, context):
+    html = render_template('watch_playlist.html', **context, **get_playlist_context(playlist))
+    return render_template('watch_slot.html', slot='playlist-slot', html=html)
+
+def warm_video(video_id):
+    get_video_info(video_id)
+    get_stream_url(video_id)
+
+def prefetch_next_videos(video=None, playlist=None, playlist_index=0):
+    # The next playlist entry is the likeliest click, then related videos in
+    # the order they are shown.
+    if playlist:
+        videos = playlist.get('videos', [])
+        if 0 <= playlist_index + 1 < len(videos):
+            prefetcher.submit(videos[playlist_index + 1].get('id'), 0)
+    if video:
+        for rank, related in enumerate(video.get('related', [])[:PREFETCH_RELATED]):
+            prefetcher.submit(related.get('id'), rank + 1)
+
+def stream_watch_page(context):
+    # Flush the shell (player, title, related videos) as soon as video info
+    # and stream URLs are in, then fill in the playlist sidebar when it
+    # arrives. Comments are not part of this: the page loads them on demand
+    # from /comments.
+    video_id = context['video_id']
+    deadline = set_deadline(WATCH_PAGE_DEADLINE)
+    futures = submit_watch_fetches(video_id, context['playlist_id'])
+    shell_futures = {f: name for f, name in futures.items() if name in ('video', 'streams')}
+    playlist_futures = {f: name for f, name in futures.items() if name == 'playlist'}
+
+    results = {'video': None, 'streams': get_empty_stream_urls(video_id)}
+    for name, value in iter_watch_results(video_id, shell_futures, deadline):
+        if value is not None:
+            results[name] = value
+
+    shell = render_template('watch.html', **context, video=results['video'], streams=results['streams'],
+                            streaming=True, **get_playlist_context(None))
+    head, body_end, tail = shell.rpartition('</body>')
+    prefetch_next_videos(video=results['video'])
+
+    def generate():
+        yield head
+        if playlist_futures:
+            playlist = None
+            for _, value in iter_watch_results(video_id, playlist_futures, deadline):
+                playlist = value
+            prefetch_next_videos(playlist=playlist, playlist_index=context['playlist_index'])
+            yield render_playlist_slot(playlist, context)
+        yield body_end + tail
+
+    response = Response(stream_with_context(generate()), mimetype='text/html')
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def resolve_batch_video(video_id, include_streams):
+    info = get_video_info(video_id)
+    if info is None:
+        status = 'not_found' if is_known_missing('video', video_id) else 'unavailable'
+        return {'id': video_id, 'status': status, 'info': None, 'streams': None}
+    streams = get_stream_url(video_id) if include_streams else None
+    return {'id': video_id, 'status': 'ok', 'info': info, 'streams': streams}
+
+def iter_batch_videos(video_ids, include_streams):
+    # Yields one result per ID in completion order; IDs still unresolved at
+    # the deadline are reported rather than holding the whole batch.
+    set_deadline(BATCH_DEADLINE)
+    futures = {submit_with_deadline(_batch_executor, resolve_batch_video, video_id, include_streams): video_id
+               for video_id in video_ids}
+    yielded = set()
+    try:
+        for future in as_completed(futures, timeout=BATCH_DEADLINE):
+            yielded.add(future)
+            yield get_batch_result(future, futures[future])
+    except TimeoutError:
+        # A future may have finished between the timeout and this loop.
+        for future, video_id in futures.items():
+            if future in yielded:
+                continue
+            if future.done():
+                yield get_batch_result(future, video_id)
+            else:
+                future.cancel()
+                yield {'id': video_id, 'status': 'timeout', 'info': None, 'streams': None}
+
+def get_batch_result(future, video_id):
+    try:
+        return future.result()
+    except Exception as e:
+        print(f"Batch video error for {video_id}: {e}")
+        return {'id': video_id, 'status': 'error', 'info': None, 'streams': None}
+
+def is_proxyable_media_url(url):
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        return False
+    host = parsed.hostname.lower()
+    if host.endswith('.googlevideo.com'):
+        return True
+    allowed_hosts = {urllib.parse.urlparse(api).hostname for api in (STREAM_API, M3U8_API)}
+    allowed_hosts.update(urllib.parse.urlparse(instance).hostname for instance in INVIDIOUS_INSTANCES)
+    return host in allowed_hosts
+
+def is_trusted_proxy(address):
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(address in network for network in MEDIA_PROXY_TRUSTED_PROXIES)
+
+def get_media_proxy_client():
+    client = request.remote_addr or ''
+    if is_trusted_proxy(client):
+        # The trusted proxy appends the address it saw; earlier entries are
+        # whatever the client chose to send.
+        forwarded = request.headers.get('X-Forwarded-For', '').split(',')[-1].strip()
+        client = forwarded or client
+    return client
+
+def get_media_following_redirects(fetch, url):
+    # fetch must not follow redirects itself: each hop is checked against
+    # the proxy allowlist before it is requested.
+    for _ in range(MEDIA_PROXY_MAX_REDIRECTS + 1):
+        res = fetch(url)
+        if not res.is_redirect:
+            return res
+        url = urllib.parse.urljoin(url, res.headers.get('Location', ''))
+        res.close()
+        if not is_proxyable_media_url(url):
+            raise ValueError(f"Redirect to a host outside the allowlist: {url}")
+    raise ValueError(f"Too many redirects for {url}")
+
+def acquire_media_proxy_slot(client):
+    with _media_proxy_lock:
+        if _media_proxy_clients.get(client, 0) >= MEDIA_PROXY_PER_CLIENT:
+            return False
+        _media_proxy_clients[client] = _media_proxy_clients.get(client, 0) + 1
+    if _media_proxy_slots.acquire(timeout=MEDIA_PROXY_QUEUE_TIMEOUT):
+        return True
+    release_media_proxy_client(client)
+    return False
+
+def release_media_proxy_client(client):
+    with _media_proxy_lock:
+        remaining = _media_proxy_clients.get(client, 0) - 1
+        if remaining > 0:
+            _media_proxy_clients[client] = remaining
+        else:
+            _media_proxy_clients.pop(client, None)
+
+def hls_proxy_url(url, is_playlist):
+    return url_for('proxy_hls' if is_playlist else 'proxy_hls_segment', url=url)
+
+def remember_hls_segment_order(segments):
+    with _hls_lock:
+        for i, segment in enumerate(segments):
+            _hls_next_segments[segment] = segments[i + 1:i + 1 + HLS_PREFETCH_SEGMENTS]
+            _hls_next_segments.move_to_end(segment)
+        while len(_hls_next_segments) > HLS_SEGMENT_INDEX_SIZE:
+            _hls_next_segments.popitem(last=False)
+
+def rewrite_hls_playlist(text, base_url):
+    lines = text.splitlines()
+    is_master = any(line.startswith('#EXT-X-STREAM-INF') for line in lines)
+    segments = []
+    output = []
+    for line in lines:
+        stripped = line.strip()
+        if not stripped:
+            output.append(line)
+        elif stripped.startswith('#'):
+            if 'URI="' in stripped:
+                is_playlist_tag = stripped.startswith(('#EXT-X-MEDIA', '#EXT-X-I-FRAME-STREAM-INF'))
+                stripped = HLS_URI_ATTRIBUTE.sub(
+                    lambda m: 'URI="' + hls_proxy_url(urllib.parse.urljoin(base_url, m.group(1)), is_playlist_tag) + '"',
+                    stripped)
+            output.append(stripped)
+        else:
+            absolute_url = urllib.parse.urljoin(base_url, stripped)
+            if not is_master:
+                segments.append(absolute_url)
+            output.append(hls_proxy_url(absolute_url, is_master))
+    remember_hls_segment_order(segments)
+    return '\n'.join(output) + '\n'
+
+def load_hls_segment(url):
+    entry = hls_segment_cache.peek('hls_segment', url)
+    if entry is not None:
+        return entry
+    host = urllib.parse.urlparse(url).hostname or ''
+    started = time.time()
+    try:
+        with trace_span('media', host=host) as span:
+            res = get_media_following_redirects(
+                lambda hop: media_session.get(hop, headers=get_random_headers(), timeout=get_budget_timeout((5, 15)),
+                                              allow_redirects=False),
+                url)
+            span['status'] = res.status_code
+    except Exception as e:
+        record_upstream_result(host, started, type(e).__name__)
+        print(f"HLS segment fetch error: {e}")
+        return None
+    record_upstream_result(host, started, res.status_code)
+    if res.status_code != 200:
+        return None
+    entry = (res.content, res.headers.get('Content-Type', 'video/mp2t'))
+    hls_segment_cache.set('hls_segment', url, entry)
+    return entry
+
+def get_hls_segment(url):
+    entry = hls_segment_cache.get('hls_segment', url)
+    if entry is not None:
+        return entry
+    return single_flight(f"hls:{url}", lambda: load_hls_segment(url))
+
+def prefetch_hls_segments(url):
+    with _hls_lock:
+        upcoming = list(_hls_next_segments.get(url, []))
+    for segment_url in upcoming:
+        _hls_prefetch_executor.submit(run_with_deadline, BACKGROUND_DEADLINE, get_hls_segment, segment_url)
+
+def no_store(response):
+    # Degraded answers to cacheable endpoints: add_header keeps this header
+    # instead of applying the endpoint's public policy.
+    response.headers['Cache-Control'] = 'no-store'
+    return response
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -533,14 +2472,15 @@ def search():
     if not query:
         return render_template('search.html', results=[], query='', vc=vc, proxy=proxy, theme=theme, next='')
 
-    results = get_youtube_search(query) if page == '1' else invidious_search(query, int(page))
-    next_page = f"/search?q={urllib.parse.quote(query)}&page={int(page) + 1}"
+    page = int(page)
+    results = get_search_page(query, page)
+    if results:
+        prefetch_page(get_search_page, query, page + 1)
+    next_page = f"/search?q={urllib.parse.quote(query)}&page={page + 1}"
 
     return render_template('search.html', results=results, query=query, vc=vc, proxy=proxy, theme=theme, next=next_page)
 
-@app.route('/watch')
-@login_required
-def watch():
+def render_watch_page(mode):
     video_id = request.args.get('v', '')
     playlist_id = request.args.get('list', '')
     playlist_index = request.args.get('index', '0')
@@ -550,141 +2490,45 @@ def watch():
     if not video_id:
         return render_template('index.html', videos=get_trending(), theme=theme)
 
-    video_info = get_video_info(video_id)
-    stream_urls = get_stream_url(video_id)
-    comments = get_comments(video_id)
-    
-    playlist_videos = []
-    playlist_title = ''
-    if playlist_id:
-        playlist_info = get_playlist_info(playlist_id)
-        if playlist_info:
-            playlist_videos = playlist_info.get('videos', [])
-            playlist_title = playlist_info.get('title', '')
+    context = {
+        'video_id': video_id,
+        'mode': mode,
+        'theme': theme,
+        'proxy': proxy,
+        'playlist_id': playlist_id,
+        'playlist_index': int(playlist_index)
+    }
+    if request.args.get('stream', WATCH_STREAMING) in ('1', 'true', 'True'):
+        return stream_watch_page(context)
 
+    data = fetch_watch_data(video_id, playlist_id)
+    prefetch_next_videos(data['video'], data['playlist'], context['playlist_index'])
     return render_template('watch.html',
-                         video_id=video_id,
-                         video=video_info,
-                         streams=stream_urls,
-                         comments=comments,
-                         mode='stream',
-                         theme=theme,
-                         proxy=proxy,
-                         playlist_id=playlist_id,
-                         playlist_index=int(playlist_index),
-                         playlist_videos=playlist_videos,
-                         playlist_title=playlist_title)
+                         **context,
+                         video=data['video'],
+                         streams=data['streams'],
+                         streaming=False,
+                         **get_playlist_context(data['playlist']))
+
+@app.route('/watch')
+@login_required
+def watch():
+    return render_watch_page('stream')
 
 @app.route('/w')
 @login_required
 def watch_high_quality():
-    video_id = request.args.get('v', '')
-    playlist_id = request.args.get('list', '')
-    playlist_index = request.args.get('index', '0')
-    theme = request.cookies.get('theme', 'dark')
-    proxy = request.cookies.get('proxy', 'False')
-
-    if not video_id:
-        return render_template('index.html', videos=get_trending(), theme=theme)
-
-    video_info = get_video_info(video_id)
-    stream_urls = get_stream_url(video_id)
-    comments = get_comments(video_id)
-    
-    playlist_videos = []
-    playlist_title = ''
-    if playlist_id:
-        playlist_info = get_playlist_info(playlist_id)
-        if playlist_info:
-            playlist_videos = playlist_info.get('videos', [])
-            playlist_title = playlist_info.get('title', '')
-
-    return render_template('watch.html',
-                         video_id=video_id,
-                         video=video_info,
-                         streams=stream_urls,
-                         comments=comments,
-                         mode='high',
-                         theme=theme,
-                         proxy=proxy,
-                         playlist_id=playlist_id,
-                         playlist_index=int(playlist_index),
-                         playlist_videos=playlist_videos,
-                         playlist_title=playlist_title)
+    return render_watch_page('high')
 
 @app.route('/ume')
 @login_required
 def watch_embed():
-    video_id = request.args.get('v', '')
-    playlist_id = request.args.get('list', '')
-    playlist_index = request.args.get('index', '0')
-    theme = request.cookies.get('theme', 'dark')
-    proxy = request.cookies.get('proxy', 'False')
-
-    if not video_id:
-        return render_template('index.html', videos=get_trending(), theme=theme)
-
-    video_info = get_video_info(video_id)
-    stream_urls = get_stream_url(video_id)
-    comments = get_comments(video_id)
-    
-    playlist_videos = []
-    playlist_title = ''
-    if playlist_id:
-        playlist_info = get_playlist_info(playlist_id)
-        if playlist_info:
-            playlist_videos = playlist_info.get('videos', [])
-            playlist_title = playlist_info.get('title', '')
-
-    return render_template('watch.html',
-                         video_id=video_id,
-                         video=video_info,
-                         streams=stream_urls,
-                         comments=comments,
-                         mode='embed',
-                         theme=theme,
-                         proxy=proxy,
-                         playlist_id=playlist_id,
-                         playlist_index=int(playlist_index),
-                         playlist_videos=playlist_videos,
-                         playlist_title=playlist_title)
+    return render_watch_page('embed')
 
 @app.route('/edu')
 @login_required
 def watch_education():
-    video_id = request.args.get('v', '')
-    playlist_id = request.args.get('list', '')
-    playlist_index = request.args.get('index', '0')
-    theme = request.cookies.get('theme', 'dark')
-    proxy = request.cookies.get('proxy', 'False')
-
-    if not video_id:
-        return render_template('index.html', videos=get_trending(), theme=theme)
-
-    video_info = get_video_info(video_id)
-    stream_urls = get_stream_url(video_id)
-    comments = get_comments(video_id)
-    
-    playlist_videos = []
-    playlist_title = ''
-    if playlist_id:
-        playlist_info = get_playlist_info(playlist_id)
-        if playlist_info:
-            playlist_videos = playlist_info.get('videos', [])
-            playlist_title = playlist_info.get('title', '')
-
-    return render_template('watch.html',
-                         video_id=video_id,
-                         video=video_info,
-                         streams=stream_urls,
-                         comments=comments,
-                         mode='education',
-                         theme=theme,
-                         proxy=proxy,
-                         playlist_id=playlist_id,
-                         playlist_index=int(playlist_index),
-                         playlist_videos=playlist_videos,
-                         playlist_title=playlist_title)
+    return render_watch_page('education')
 
 @app.route('/channel/<channel_id>')
 @login_required
@@ -693,12 +2537,26 @@ def channel(channel_id):
     vc = request.cookies.get('vc', '1')
     proxy = request.cookies.get('proxy', 'False')
 
-    channel_info = get_channel_info(channel_id)
+    deadline = set_deadline(CHANNEL_PAGE_DEADLINE)
+    info_future = submit_with_deadline(_page_executor, get_channel_info, channel_id)
+    videos_future = submit_with_deadline(_page_executor, get_channel_videos, channel_id)
+    try:
+        channel_info = info_future.result(timeout=max(0, deadline - time.time()))
+    except Exception as e:
+        print(f"Channel info error for {channel_id}: {e}")
+        channel_info = None
 
     if not channel_info:
+        videos_future.cancel()
         return render_template('channel.html', channel=None, videos=[], theme=theme, vc=vc, proxy=proxy, channel_id=channel_id, continuation='', total_videos=0)
 
-    channel_videos = get_channel_videos(channel_id)
+    try:
+        channel_videos = videos_future.result(timeout=max(0, deadline - time.time()))
+    except Exception as e:
+        print(f"Channel videos error for {channel_id}: {e}")
+        channel_videos = None
+    if channel_videos and channel_videos.get('continuation'):
+        prefetch_page(get_channel_videos, channel_id, channel_videos['continuation'])
     videos = channel_videos.get('videos', []) if channel_videos else channel_info.get('videos', [])
     continuation = channel_videos.get('continuation', '') if channel_videos else ''
     total_videos = channel_info.get('videoCount', 0)
@@ -768,56 +2626,154 @@ def thumbnail():
     if not video_id:
         return '', 404
 
-    current_time = time.time()
-    cache_key = video_id
-    if cache_key in _thumbnail_cache:
-        cached_data, cached_time = _thumbnail_cache[cache_key]
-        if current_time - cached_time < 3600:
-            response = Response(cached_data, mimetype='image/jpeg')
-            response.headers['Cache-Control'] = 'public, max-age=3600'
+    entry = thumbnail_store.get(video_id)
+    if entry is None:
+        try:
+            url = f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg"
+            with bulkheads['thumbnail']:
+                res = upstream_get(url, headers=get_random_headers(), timeout=3)
+        except BulkheadFull:
+            response = Response('', status=503)
+            response.headers['Retry-After'] = '1'
+            return response
+        except:
+            return '', 404
+        if res.status_code != 200:
+            response = Response(res.content, mimetype='image/jpeg')
+            response.headers['Cache-Control'] = 'no-store'
             return response
+        entry = thumbnail_store.set(video_id, res.content)
 
-    try:
-        url = f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg"
-        res = http_session.get(url, headers=get_random_headers(), timeout=3)
-        if len(_thumbnail_cache) > 500:
-            oldest_key = min(_thumbnail_cache.keys(), key=lambda k: _thumbnail_cache[k][1])
-            del _thumbnail_cache[oldest_key]
-        _thumbnail_cache[cache_key] = (res.content, current_time)
-        response = Response(res.content, mimetype='image/jpeg')
-        response.headers['Cache-Control'] = 'public, max-age=3600'
+    data, etag, stored_at = entry
+    response = Response(data, mimetype='image/jpeg')
+    response.set_etag(etag)
+    response.last_modified = datetime.datetime.fromtimestamp(stored_at, datetime.timezone.utc)
+    return response
+
+@app.route('/proxy/stream')
+@login_required
+def proxy_stream():
+    url = request.args.get('url', '')
+    if not is_proxyable_media_url(url):
+        return '', 400
+
+    client = get_media_proxy_client()
+    if not acquire_media_proxy_slot(client):
+        response = Response('', status=503)
+        response.headers['Retry-After'] = '2'
         return response
-    except:
-        return '', 404
+
+    released = threading.Event()
+
+    def release():
+        if not released.is_set():
+            released.set()
+            _media_proxy_slots.release()
+            release_media_proxy_client(client)
+
+    headers = get_random_headers()
+    for name in MEDIA_PROXY_FORWARD_HEADERS:
+        if name in request.headers:
+            headers[name] = request.headers[name]
+
+    host = urllib.parse.urlparse(url).hostname or ''
+    started = time.time()
+    try:
+        with trace_span('media', host=host) as span:
+            res = get_media_following_redirects(
+                lambda hop: media_session.get(hop, headers=headers, timeout=(5, 30), stream=True, allow_redirects=False),
+                url)
+            span['status'] = res.status_code
+    except Exception as e:
+        record_upstream_result(host, started, type(e).__name__)
+        print(f"Media proxy upstream error: {e}")
+        release()
+        return '', 502
+    record_upstream_result(host, started, res.status_code)
+
+    def generate():
+        try:
+            for chunk in res.iter_content(chunk_size=MEDIA_PROXY_CHUNK_SIZE):
+                if chunk:
+                    yield chunk
+        except Exception as e:
+            print(f"Media proxy stream error: {e}")
+        finally:
+            res.close()
+            release()
+
+    response = Response(generate(), status=res.status_code, direct_passthrough=True)
+    for name in MEDIA_PROXY_RESPONSE_HEADERS:
+        if name in res.headers:
+            response.headers[name] = res.headers[name]
+    response.headers['Cache-Control'] = 'no-store'
+    # Runs even if the client disconnects before the body is iterated.
+    response.call_on_close(res.close)
+    response.call_on_close(release)
+    return response
+
+@app.route('/proxy/hls')
+@login_required
+def proxy_hls():
+    url = request.args.get('url', '')
+    if not is_proxyable_media_url(url):
+        return '', 400
+
+    try:
+        res = get_media_following_redirects(
+            lambda hop: upstream_get(hop, headers=get_random_headers(), timeout=(3, 10), allow_redirects=False),
+            url)
+    except Exception as e:
+        print(f"HLS playlist fetch error: {e}")
+        return '', 502
+    if res.status_code != 200:
+        return '', 502
+
+    # Redirects change the base that relative URIs resolve against.
+    playlist = rewrite_hls_playlist(res.text, res.url)
+    response = Response(playlist, mimetype='application/vnd.apple.mpegurl')
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/proxy/hls/segment')
+@login_required
+def proxy_hls_segment():
+    url = request.args.get('url', '')
+    if not is_proxyable_media_url(url):
+        return '', 400
+    if 'Range' in request.headers:
+        return proxy_stream()
+
+    entry = get_hls_segment(url)
+    prefetch_hls_segments(url)
+    if entry is None:
+        return '', 502
+
+    data, content_type = entry
+    response = Response(data, mimetype=content_type)
+    response.headers['Cache-Control'] = 'private, max-age=300'
+    return response
 
 @app.route('/suggest')
 def suggest():
     keyword = request.args.get('keyword', '')
     suggestions = get_suggestions(keyword)
+    if suggestions is None:
+        return no_store(jsonify([]))
     return jsonify(suggestions)
 
 @app.route('/comments')
 def comments_api():
     video_id = request.args.get('v', '')
-    comments = get_comments(video_id)
-
-    html = ''
-    for comment in comments:
-        html += f'''
-        <div class="comment">
-            <img src="{comment['authorThumbnail']}" alt="{comment['author']}" class="comment-avatar">
-            <div class="comment-content">
-                <div class="comment-header">
-                    <a href="/channel/{comment['authorId']}" class="comment-author">{comment['author']}</a>
-                    <span class="comment-date">{comment['published']}</span>
-                </div>
-                <div class="comment-text">{comment['content']}</div>
-                <div class="comment-likes">👍 {comment['likes']}</div>
-            </div>
-        </div>
-        '''
-
-    return html if html else '<p class="no-comments">コメントはありません</p>'
+    if not video_id:
+        return '', 400
+    continuation = request.args.get('continuation', '')
+    html = get_comments_html(video_id, continuation or None)
+    if html is None:
+        # Upstream failure: show the empty state without letting it be cached.
+        html = render_template('watch_comments.html', video_id=video_id, comments=[], continuation='')
+        return no_store(Response(html, mimetype='text/html'))
+    return html
 
 @app.route('/api/search')
 def api_search():
@@ -826,29 +2782,168 @@ def api_search():
         return jsonify({'error': 'Query required'}), 400
 
     results = get_youtube_search(query)
+    if not results:
+        return no_store(jsonify(results or []))
     return jsonify(results)
 
 @app.route('/api/video/<video_id>')
 def api_video(video_id):
     info = get_video_info(video_id)
+    if info is None and is_known_missing('video', video_id):
+        return jsonify({'info': None, 'streams': None}), 404
     streams = get_stream_url(video_id)
     return jsonify({'info': info, 'streams': streams})
 
+@app.route('/api/videos', methods=['GET', 'POST'])
+def api_videos():
+    if request.method == 'POST':
+        payload = request.get_json(silent=True) or {}
+        if not isinstance(payload, dict):
+            return jsonify({'error': 'body must be a JSON object'}), 400
+        ids = payload.get('ids', [])
+        include_streams = payload.get('streams', True)
+    else:
+        ids = request.args.get('ids', '').split(',')
+        include_streams = request.args.get('streams', '1')
+    include_streams = str(include_streams).lower() not in ('0', 'false')
+
+    if not isinstance(ids, list):
+        return jsonify({'error': 'ids must be a list'}), 400
+    video_ids = list(dict.fromkeys(str(video_id).strip() for video_id in ids if str(video_id).strip()))
+    if not video_ids:
+        return jsonify({'error': 'ids required'}), 400
+    if len(video_ids) > BATCH_MAX_IDS:
+        return jsonify({'error': f'at most {BATCH_MAX_IDS} ids per request'}), 400
+
+    results = iter_batch_videos(video_ids, include_streams)
+    if request.args.get('stream') == '1' or 'application/x-ndjson' in request.headers.get('Accept', ''):
+        lines = (json.dumps(result, ensure_ascii=False) + '\n' for result in results)
+        return Response(stream_with_context(lines), mimetype='application/x-ndjson')
+
+    by_id = {result['id']: result for result in results}
+    return jsonify({'results': [by_id[video_id] for video_id in video_ids]})
+
 @app.route('/api/trending')
 def api_trending():
     videos = get_trending()
+    if videos is DEFAULT_TRENDING_VIDEOS:
+        return no_store(jsonify(videos))
     return jsonify(videos)
 
+@app.route('/api/instances')
+def api_instances():
+    return jsonify(get_instance_scoreboard())
+
+@app.route('/api/bulkheads')
+def api_bulkheads():
+    return jsonify({name: bulkhead.get_stats() for name, bulkhead in bulkheads.items()})
+
+@app.route('/api/cache')
+def api_cache():
+    stats = cache.get_stats()
+    stats['thumbnails'] = thumbnail_store.get_stats()
+    stats['suggestions'] = suggestion_index.get_stats()
+    stats['prefetch'] = prefetcher.get_stats()
+    return jsonify(stats)
+
+@app.route('/metrics')
+def metrics_page():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/channel/<channel_id>/videos')
 def api_channel_videos(channel_id):
     continuation = request.args.get('continuation', '')
     result = get_channel_videos(channel_id, continuation if continuation else None)
     if not result:
-        return jsonify({'videos': [], 'continuation': ''})
+        return no_store(jsonify({'videos': [], 'continuation': ''}))
+    if result.get('continuation'):
+        prefetch_page(get_channel_videos, channel_id, result['continuation'])
     return jsonify(result)
 
+@app.template_filter('media_url')
+def media_url(url, proxy='False'):
+    if url and proxy == 'True' and is_proxyable_media_url(url):
+        return url_for('proxy_stream', url=url)
+    return url
+
+@app.template_filter('hls_url')
+def hls_url(url, proxy='False'):
+    if url and proxy == 'True' and is_proxyable_media_url(url):
+        return url_for('proxy_hls', url=url)
+    return url
+
+@app.before_request
+def start_request_deadline():
+    set_deadline(REQUEST_DEADLINE)
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.time()
+    metrics.add_gauge('http_requests_in_flight', 1)
+
+@app.before_request
+def start_request_trace():
+    _current_trace.set(RequestTrace())
+    _current_span.set(None)
+
+@app.after_request
+def add_server_timing(response):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.status = response.status_code
+        if SERVER_TIMING == 'true':
+            response.headers['Server-Timing'] = trace.get_server_timing()
+    return response
+
+@app.teardown_request
+def log_slow_request(exc):
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    _current_trace.set(None)
+    duration = time.time() - trace.started
+    if duration < SLOW_REQUEST_THRESHOLD:
+        return
+    print(json.dumps({
+        'event': 'slow_request',
+        'method': request.method,
+        'path': request.path,
+        'route': request.url_rule.rule if request.url_rule else 'unmatched',
+        'status': 500 if exc is not None else trace.status,
+        'durationMs': round(duration * 1000, 1),
+        'spans': trace.get_waterfall()
+    }, default=str))
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    started = g.pop('request_started', None)
+    if started is None:
+        return
+    metrics.add_gauge('http_requests_in_flight', -1)
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.observe('http_request_duration_seconds', time.time() - started, route=route, method=request.method)
+
+@app.after_request
+def count_response(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.inc('http_requests_total', route=route, method=request.method, status=str(response.status_code))
+    return response
+
 @app.after_request
 def add_header(response):
+    # A route that sets Cache-Control itself has already decided.
+    if 'Cache-Control' in response.headers:
+        return response
+
+    policy = CACHE_POLICIES.get(request.endpoint)
+    if policy and response.status_code == 200:
+        response.headers['Cache-Control'] = policy
+        if not response.direct_passthrough and not response.is_streamed:
+            if 'ETag' not in response.headers:
+                response.add_etag()
+            response.make_conditional(request)
+        return response
+
     response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
     response.headers['Pragma'] = 'no-cache'
     response.headers['Expires'] = '0'
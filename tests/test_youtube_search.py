@@ -0,0 +1,102 @@
+import json
+import os
+import sys
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+os.environ.setdefault('CACHE_BACKEND', 'memory')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import app
+
+
+PAGE_SIZE = 20
+
+
+class YouTubeStub(BaseHTTPRequestHandler):
+    # Minimal search.list / videos.list stand-in; records every request.
+    requests = []
+
+    def do_GET(self):
+        parsed = urllib.parse.urlparse(self.path)
+        params = urllib.parse.parse_qs(parsed.query)
+        YouTubeStub.requests.append((parsed.path, params))
+        if parsed.path.endswith('/search'):
+            body = {'items': [
+                {'id': {'videoId': f'vid{i:02d}'},
+                 'snippet': {'title': f'Video {i}', 'channelTitle': 'Channel', 'channelId': 'UC1'}}
+                for i in range(PAGE_SIZE)
+            ]}
+        elif parsed.path.endswith('/videos'):
+            ids = params['id'][0].split(',')
+            body = {'items': [
+                {'id': video_id,
+                 'statistics': {'viewCount': '1234567'},
+                 'contentDetails': {'duration': 'PT1H2M3S'}}
+                for video_id in ids
+            ]}
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def youtube_stub(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), YouTubeStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    YouTubeStub.requests = []
+    monkeypatch.setattr(app, 'YOUTUBE_API_BASE', f'http://127.0.0.1:{server.server_port}/youtube/v3')
+    monkeypatch.setattr(app, 'YOUTUBE_API_KEY', 'test-key')
+    monkeypatch.setattr(app, 'cache', app.MemoryCacheBackend(app.CACHE_MAX_BYTES))
+    yield YouTubeStub.requests
+    server.shutdown()
+    server.server_close()
+
+
+def test_search_page_is_enriched_with_one_videos_call(youtube_stub):
+    results = app.fetch_youtube_search('test query', max_results=PAGE_SIZE)
+
+    videos_calls = [params for path, params in youtube_stub if path.endswith('/videos')]
+    assert len(videos_calls) == 1
+    assert videos_calls[0]['id'][0].split(',') == [f'vid{i:02d}' for i in range(PAGE_SIZE)]
+    assert videos_calls[0]['part'][0] == 'statistics,contentDetails'
+
+    assert len(results) == PAGE_SIZE
+    for item in results:
+        assert item['views'] == '1,234,567 回視聴'
+        assert item['length'] == '1:02:03'
+
+
+def test_cached_stats_skip_videos_call(youtube_stub):
+    app.fetch_youtube_search('test query', max_results=PAGE_SIZE)
+    app.fetch_youtube_search('test query', max_results=PAGE_SIZE)
+
+    videos_calls = [path for path, params in youtube_stub if path.endswith('/videos')]
+    assert len(videos_calls) == 1
+
+
+@pytest.mark.parametrize('duration, seconds', [
+    ('PT1H2M3S', 3723),
+    ('PT45S', 45),
+    ('PT10M', 600),
+    ('P1DT1S', 86401),
+    ('P0D', 0),
+    ('', 0),
+    (None, 0),
+    ('garbage', 0),
+])
+def test_parse_iso8601_duration(duration, seconds):
+    assert app.parse_iso8601_duration(duration) == seconds